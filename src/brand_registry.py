@@ -0,0 +1,168 @@
+"""
+Persistent registry of input brands: features, similarity cutoffs and
+quantile knots of every registered brand image, stored in a single .npz file
+so that brands can be added or removed one at a time without re-featurizing
+the others.
+"""
+import hashlib
+import numpy as np
+import os
+
+from similarity import BrandIndex, cdf_quantiles, features_fingerprint, load_brands_compute_cutoffs
+
+
+class BrandRegistry(object):
+    """
+    Brands registered against one logo database and feature extractor.
+
+    Only add_brand() and add_brands() need the extractor: a registry opened without
+    model_preproc can still list brands, remove them and build a BrandIndex.
+
+    Args:
+      path: .npz file of the registry, created when the first brands are added
+      model_preproc: (model, preprocess) tuple of model extractor and
+        image preprocessing function
+      features: (n_database, N) array of features for logo database
+      threshold: fractional threshold for setting the cutoffs
+      extractor_key: string identifying the feature extractor (e.g. features
+        file name)
+    """
+
+    def __init__(self, path, model_preproc=None, features=None, threshold=0.95, extractor_key=''):
+        self.path = path
+        self.model_preproc = model_preproc
+        self.features = features
+        self.threshold = threshold
+        self.extractor_key = extractor_key
+        self.db_fingerprint = features_fingerprint(features) if features is not None else ''
+
+        self.names = []
+        self.hashes = []
+        self.feat = None
+        self.cutoffs = np.zeros(0)
+        self.knots = np.zeros((0, len(cdf_quantiles)))
+        self.bins = cdf_quantiles
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with np.load(self.path) as entry:
+            meta = (str(entry['extractor_key']), str(entry['db_fingerprint']), float(entry['threshold']))
+            if self.features is not None and meta != (self.extractor_key, self.db_fingerprint, float(self.threshold)):
+                raise Exception(f'Brand registry {self.path} was built with another feature extractor, '
+                                f'logo database or threshold: remove it to register brands again')
+            self.extractor_key, self.db_fingerprint, self.threshold = meta
+            self.names = [str(n) for n in entry['names']]
+            self.hashes = [str(h) for h in entry['hashes']]
+            self.feat = entry['feat']
+            self.cutoffs = entry['cutoffs']
+            self.knots = entry['knots']
+            self.bins = entry['bins']
+
+    def _save(self):
+        '''write the registry under a temporary name unique to the process and
+        rename it, so that readers never see a partial file and concurrent
+        workers do not write to the same file'''
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, names=np.array(self.names, dtype=str), hashes=np.array(self.hashes, dtype=str),
+                     feat=self.feat, cutoffs=self.cutoffs, knots=self.knots, bins=self.bins,
+                     threshold=self.threshold, extractor_key=self.extractor_key,
+                     db_fingerprint=self.db_fingerprint)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def add_brand(self, image_path, name=None):
+        """
+        Featurize one brand image, compute its similarity cutoff against the
+        logo database and save it to the registry. A brand already registered
+        under the same name is replaced, unless the image is unchanged.
+
+        Args:
+          image_path: path to brand image
+          name: brand name, default image file name without extension
+        Returns:
+          True if the registry was modified
+        """
+        return self.add_brands([image_path], [name]) > 0
+
+    def add_brands(self, image_paths, names=None):
+        """
+        Register several brands as add_brand() does, featurizing all new or
+        changed images in a single batch and saving the registry once.
+
+        Args:
+          image_paths: list of paths to brand images
+          names: list of brand names, default image file names without
+            extension. For repeated names, the last image is registered.
+        Returns:
+          number of brands added or replaced
+        """
+        if self.model_preproc is None or self.features is None:
+            raise Exception('Brand registry needs model_preproc and features to add brands')
+
+        names = names or [None] * len(image_paths)
+        todo = {}
+        for image_path, name in zip(image_paths, names):
+            name = name or os.path.splitext(os.path.basename(image_path))[0]
+            with open(image_path, 'rb') as f:
+                image_hash = hashlib.sha1(f.read()).hexdigest()
+            todo.pop(name, None)
+            if name not in self.names or self.hashes[self.names.index(name)] != image_hash:
+                todo[name] = (image_path, image_hash)
+        if len(todo) == 0:
+            return 0
+
+        paths = [image_path for image_path, _ in todo.values()]
+        img_input, feat_input, sim_cutoff, (bins, cdf_list) = load_brands_compute_cutoffs(
+            paths, self.model_preproc, self.features, self.threshold,
+            extractor_key=self.extractor_key)
+        if len(img_input) != len(paths):
+            raise Exception(f'Could not read {len(paths) - len(img_input)} of the brand images {paths}')
+
+        for name in todo:
+            if name in self.names:
+                self._delete(self.names.index(name))
+        self.names.extend(todo)
+        self.hashes.extend(image_hash for _, image_hash in todo.values())
+        self.feat = feat_input if self.feat is None else np.concatenate([self.feat, feat_input])
+        self.cutoffs = np.append(self.cutoffs, sim_cutoff)
+        self.knots = np.concatenate([self.knots, np.asarray(cdf_list).reshape(len(paths), -1)])
+        self.bins = bins
+        self._save()
+        return len(todo)
+
+    def remove_brand(self, name):
+        """
+        Remove a brand from the registry.
+
+        Args:
+          name: brand name
+        Returns:
+          True if the brand was registered
+        """
+        if name not in self.names:
+            return False
+        self._delete(self.names.index(name))
+        self._save()
+        return True
+
+    def _delete(self, i):
+        del self.names[i], self.hashes[i]
+        self.feat = np.delete(self.feat, i, axis=0)
+        self.cutoffs = np.delete(self.cutoffs, i)
+        self.knots = np.delete(self.knots, i, axis=0)
+
+    def index(self, dtype=np.float32, search=None):
+        """
+        BrandIndex of the registered brands, in the order of self.names.
+        """
+        if len(self.names) == 0:
+            raise Exception(f'No brands registered in {self.path}')
+        return BrandIndex(self.feat, self.cutoffs, self.bins, self.knots, dtype, search)
@@ -0,0 +1,204 @@
+"""
+Nearest-neighbour search backends of BrandIndex over L2-normalized brand
+features: exact brute force, and an inverted-file (IVF) index for large
+brand catalogs.
+
+Run as a script to benchmark recall and latency of IVF against exact search
+on synthetic data.
+"""
+import argparse
+import numpy as np
+from timeit import default_timer as timer
+
+from quantization import Int8Features
+
+# rows of float16 vectors converted to float32 at a time in inner products
+float16_chunk_size = 8192
+
+
+def inner_products(vectors, queries):
+    """
+    Inner products of indexed vectors, float array or Int8Features, with
+    (n_queries, N) or (N,) float queries: (n_vectors, n_queries) or (n_vectors,)
+
+    float16 vectors are only a storage format: NumPy has no BLAS kernel for
+    them, so chunks of rows are converted to float32 for the product, and the
+    queries are never rounded to float16.
+    """
+    if isinstance(vectors, Int8Features):
+        return vectors @ queries.T
+    queries = np.asarray(queries, dtype=np.float32)
+    if vectors.dtype != np.float16:
+        return vectors @ queries.astype(vectors.dtype, copy=False).T
+    out = np.empty((len(vectors),) + queries.shape[:-1], dtype=np.float32)
+    for i in range(0, len(vectors), float16_chunk_size):
+        out[i:i+float16_chunk_size] = vectors[i:i+float16_chunk_size].astype(np.float32) @ queries.T
+    return out
+
+
+class ExactSearch(object):
+    """
+    Brute-force cosine similarity of queries against every indexed vector.
+
+    Args:
+      k: number of most similar vectors returned per query, None for all of
+        them in index order
+    """
+
+    def __init__(self, k=None):
+        self.k = k
+        self.vectors = None
+
+    def fit(self, vectors):
+        """
+        Index (n_vectors, N) array of L2-normalized vectors.
+        """
+        self.vectors = vectors
+        return self
+
+    def search(self, queries):
+        """
+        Args:
+          queries: (n_queries, N) array of L2-normalized vectors
+        Returns:
+          sims: (n_queries, k) array of cosine similarities
+          ids: (n_queries, k) array of indices of the matching vectors
+        """
+        sims = inner_products(self.vectors, queries).T
+        if self.k is None or self.k >= sims.shape[1]:
+            ids = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+            return sims, ids
+
+        ids = np.argpartition(-sims, self.k - 1, axis=1)[:, :self.k]
+        return np.take_along_axis(sims, ids, axis=1), ids
+
+
+class IVFSearch(object):
+    """
+    Inverted-file index: vectors are clustered by spherical k-means, and each
+    query is only compared to the vectors of its nprobe closest clusters, so
+    that search time grows about as the square root of the catalog size.
+
+    Args:
+      k: number of most similar vectors returned per query
+      n_lists: number of k-means clusters, default sqrt(n_vectors)
+      nprobe: number of clusters visited per query
+      n_iter: number of k-means iterations
+      seed: seed of the k-means initialization
+    """
+
+    def __init__(self, k=10, n_lists=None, nprobe=8, n_iter=20, seed=0):
+        self.k = k
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def fit(self, vectors):
+        """
+        Cluster (n_vectors, N) array of L2-normalized vectors and store them
+        grouped by cluster.
+        """
+        n_lists = self.n_lists or int(np.ceil(np.sqrt(len(vectors))))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.RandomState(self.seed)
+        x = np.asarray(vectors, dtype=np.float32)
+
+        centroids = x[rng.choice(len(x), n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assign = self._assign(x, centroids)
+            counts = np.bincount(assign, minlength=n_lists)
+            order = np.argsort(assign, kind='stable')
+            sums = np.zeros_like(centroids)
+            nonempty = np.flatnonzero(counts)
+            sums[nonempty] = np.add.reduceat(x[order], (np.cumsum(counts) - counts)[nonempty])
+            # re-seed empty clusters on random vectors
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        assign = self._assign(x, centroids)
+
+        order = np.argsort(assign, kind='stable')
+        self.centroids = centroids
+        self.vectors = vectors[order]
+        self.ids = order
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        return self
+
+    @staticmethod
+    def _assign(x, centroids, chunk_size=10000):
+        '''index of the most similar centroid of each vector, in chunks of rows'''
+        return np.concatenate([np.argmax(x[i:i+chunk_size] @ centroids.T, axis=1)
+                               for i in range(0, len(x), chunk_size)])
+
+    def search(self, queries):
+        """
+        Args:
+          queries: (n_queries, N) array of L2-normalized vectors
+        Returns:
+          sims: (n_queries, k) array of cosine similarities, -inf padded
+          ids: (n_queries, k) array of indices of the matching vectors, -1 padded
+        """
+        nprobe = min(self.nprobe, len(self.centroids))
+        coarse = queries.astype(np.float32, copy=False) @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        sims = np.full((len(queries), self.k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), self.k), -1, dtype=np.int64)
+        for i, probe in enumerate(probes):
+            # inverted lists are contiguous slices of the grouped vectors
+            rows = np.concatenate([np.arange(self.offsets[p], self.offsets[p+1]) for p in probe])
+            s = np.concatenate([inner_products(self.vectors[self.offsets[p]:self.offsets[p+1]], queries[i])
+                                for p in probe])
+            top = np.argsort(-s, kind='stable')[:self.k]
+            sims[i, :len(top)] = s[top]
+            ids[i, :len(top)] = self.ids[rows[top]]
+        return sims, ids
+
+
+def recall_at_k(ids, ids_exact):
+    """
+    Fraction of the exact top-k neighbours found by an approximate search.
+    """
+    found = [len(np.intersect1d(a[a >= 0], b)) for a, b in zip(ids, ids_exact)]
+    return np.sum(found) / ids_exact.size
+
+
+def synthetic_catalog(n_vectors, dim, n_clusters=None, seed=0):
+    '''clustered L2-normalized vectors, as brand features group by visual style'''
+    rng = np.random.RandomState(seed)
+    n_clusters = n_clusters or max(1, n_vectors // 50)
+    centers = rng.normal(size=(n_clusters, dim))
+    x = centers[rng.randint(n_clusters, size=n_vectors)] + 1.5 * rng.normal(size=(n_vectors, dim))
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark IVF against exact brand search on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='catalog sizes to benchmark')
+    parser.add_argument('--dim', type=int, default=512, help='feature dimension')
+    parser.add_argument('--queries', type=int, default=200, help='number of queries')
+    parser.add_argument('--k', type=int, default=10, help='number of neighbours')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16],
+                        help='number of clusters visited per query')
+    args = parser.parse_args()
+
+    print('{:>8} {:>7} {:>10} {:>12} {:>9}'.format('brands', 'nprobe', 'recall@k', 'ms/query', 'speedup'))
+    for n in args.sizes:
+        x = synthetic_catalog(n + args.queries, args.dim)
+        catalog, queries = x[:n], x[n:]
+
+        exact = ExactSearch(args.k).fit(catalog)
+        start = timer()
+        _, ids_exact = exact.search(queries)
+        t_exact = (timer() - start) / len(queries)
+        print('{:>8} {:>7} {:>10.3f} {:>12.3f} {:>9}'.format(n, 'exact', 1., 1000 * t_exact, ''))
+
+        for nprobe in args.nprobe:
+            ivf = IVFSearch(args.k, nprobe=nprobe).fit(catalog)
+            start = timer()
+            _, ids = ivf.search(queries)
+            t_ivf = (timer() - start) / len(queries)
+            print('{:>8} {:>7} {:>10.3f} {:>12.3f} {:>8.1f}x'.format(
+                n, nprobe, recall_at_k(ids, ids_exact), 1000 * t_ivf, t_exact / t_ivf))
@@ -3,8 +3,8 @@
 Class definition of YOLO_v3 style detection model on image and video
 """
 
-import colorsys
 import os
+from collections import OrderedDict
 from timeit import default_timer as timer
 
 import numpy as np
@@ -12,10 +12,11 @@ import tensorflow as tf
 from keras import backend as K
 from keras.models import load_model
 from keras.layers import Input
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
 
-from .yolo3.model import yolo_eval, yolo_body, tiny_yolo_body
-from .yolo3.utils import letterbox_image
+from .yolo3.model import yolo_body, tiny_yolo_body, yolo_decoder, yolo_detector
+from .yolo3.postprocess import non_max_suppression, yolo_eval_np
+from .yolo3.utils import LetterboxBatch, annotation_font, class_colors, input_size_for_image, tile_windows
 from .memory_config import configure_gpu_memory
 import os
 
@@ -31,6 +32,10 @@ class YOLO(object):
         "iou" : 0.45,
         "model_image_size" : (416, 416),
         "gpu_num" : 1,
+        "backend" : 'tf',  # post-processing backend: 'tf' or 'numpy'
+        "min_logo_size" : None,  # if set, pick input size per image, see input_size_for_image
+        "input_size_range" : (320, 608),
+        "end_to_end" : False,  # uint8 input, scaling, decode and NMS inside one Keras model
     }
 
     @classmethod
@@ -45,6 +50,9 @@ class YOLO(object):
         self.__dict__.update(kwargs) # and update with user overrides
         self.class_names = self._get_class()
         self.anchors = self._get_anchors()
+        self._decoders = OrderedDict()
+        self._letterbox_buffers = OrderedDict()
+        self._detectors = OrderedDict()
         self.generate()
 
     def _get_class(self):
@@ -65,6 +73,8 @@ class YOLO(object):
         model_path = os.path.expanduser(self.model_path)
         assert model_path.endswith('.h5'), 'Keras model or weights must be a .h5 file.'
 
+        assert self.backend in ('tf', 'numpy'), 'backend must be either tf or numpy'
+
         # Load model, or construct model and load weights.
         num_anchors = len(self.anchors)
         num_classes = len(self.class_names)
@@ -82,63 +92,259 @@ class YOLO(object):
 
         print('{} model, anchors, and classes loaded.'.format(model_path))
 
-        # Generate colors for drawing bounding boxes.
-        hsv_tuples = [(x / len(self.class_names), 1., 1.)
-                      for x in range(len(self.class_names))]
-        self.colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
-        self.colors = list(
-            map(lambda x: (int(x[0] * 255), int(x[1] * 255), int(x[2] * 255)),
-                self.colors))
-        np.random.seed(10101)  # Fixed seed for consistent colors across runs.
-        np.random.shuffle(self.colors)  # Shuffle colors to decorrelate adjacent classes.
-        np.random.seed(None)  # Reset seed to default.
+        # Colors for drawing bounding boxes.
+        self.colors = list(class_colors(len(self.class_names)))
 
         if self.gpu_num>=2:
             self.yolo_model = tf.keras.utils.multi_gpu_model(self.yolo_model, gpus=self.gpu_num)
 
-    def detect_image(self, image):
-        start = timer()
+        if self.end_to_end and self.model_image_size != (None, None):
+            # build the detector for the fixed size now, _predict() reads it from the cache
+            self._detector(tuple(reversed(self.model_image_size)))
+
+    # traced decoders, detectors and letterbox buffers kept per input size:
+    # free-size mode can see many sizes, do not hold on to all of them
+    _max_cached_sizes = 8
+
+    def _cached(self, cache, key, build):
+        """Return cache[key], built on first use, evicting the least recently used entry."""
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            if len(cache) >= self._max_cached_sizes:
+                cache.popitem(last=False)
+            cache[key] = build()
+        return cache[key]
 
+    def _decoder(self, input_shape):
+        """Traced yolo_decoder for input_shape (h, w), built on first use and cached."""
+        return self._cached(self._decoders, input_shape, lambda: yolo_decoder(self.anchors,
+            len(self.class_names), input_shape,
+            score_threshold=self.score, iou_threshold=self.iou))
+
+    def _detector(self, boxed_size):
+        """End-to-end yolo_detector model for boxed_size (w, h), built on first use and cached."""
+        return self._cached(self._detectors, boxed_size, lambda: yolo_detector(self.yolo_model, self.anchors,
+            len(self.class_names), tuple(reversed(boxed_size)),
+            score_threshold=self.score, iou_threshold=self.iou))
+
+    def export_saved_model(self, export_path, embed_letterbox=True):
+        """
+        Save the whole detector (scaling, optional letterbox, YOLO body, decode
+        and NMS) as a single SavedModel for serving. Requires a fixed
+        model_image_size.
+
+        Args:
+          export_path: output directory
+          embed_letterbox: if True, the exported model takes raw uint8 images
+            of any size; otherwise letterboxed uint8 images and their (h, w)
+        """
+        assert self.model_image_size != (None, None), \
+            'Exporting the detector requires a fixed model_image_size'
+        model = yolo_detector(self.yolo_model, self.anchors, len(self.class_names),
+                              self.model_image_size, score_threshold=self.score,
+                              iou_threshold=self.iou, embed_letterbox=embed_letterbox)
+        tf.saved_model.save(model, export_path)
+
+    def _boxed_image_size(self, image):
+        """
+        Return (width, height) of the network input used for image: chosen by
+        input_size_for_image() if min_logo_size is set, else model_image_size,
+        else the image size rounded down to a multiple of 32.
+        """
+        if self.min_logo_size is not None:
+            size = input_size_for_image(image.size, self.min_logo_size,
+                                        size_range=self.input_size_range)
+            return (size, size)
         if self.model_image_size != (None, None):
             assert self.model_image_size[0]%32 == 0, 'Multiples of 32 required'
             assert self.model_image_size[1]%32 == 0, 'Multiples of 32 required'
-            boxed_image = letterbox_image(image, tuple(reversed(self.model_image_size)))
-        else:
-            new_image_size = (image.width - (image.width % 32),
-                             image.height - (image.height % 32))
-            boxed_image = letterbox_image(image, new_image_size)
-        image_data = np.array(boxed_image, dtype='float32')
-
-        print(image_data.shape)
-        image_data /= 255.
-        image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
-
-        # Make prediction
-        yolo_outputs = self.yolo_model.predict(image_data)
-        
-        # Process outputs
-        input_image_shape = tf.constant([image.size[1], image.size[0]], dtype=tf.float32)
-        boxes, scores, classes = yolo_eval(yolo_outputs, self.anchors,
-            len(self.class_names), input_image_shape,
-            score_threshold=self.score, iou_threshold=self.iou)
-
-        out_boxes = boxes.numpy()
-        out_scores = scores.numpy()
-        out_classes = classes.numpy()
+            return tuple(reversed(self.model_image_size))
+        return (image.width - (image.width % 32),
+                image.height - (image.height % 32))
 
-        print('Found {} boxes for {}'.format(len(out_boxes), 'img'))
+    def _letterbox(self, images, boxed_size, normalize=True):
+        """
+        Letterbox images into the reusable buffer for boxed_size and return the
+        (n_images, H, W, 3) float32 model input, or the uint8 images if not normalize.
+        """
+        buffer = self._letterbox_buffers.get(boxed_size)
+        if buffer is not None and len(buffer.images) < len(images):
+            # too small for this batch: rebuilt below
+            del self._letterbox_buffers[boxed_size]
+        buffer = self._cached(self._letterbox_buffers, boxed_size,
+                              lambda: LetterboxBatch(len(images), boxed_size))
 
-        # Get the font path relative to this file
-        font_path = os.path.join(os.path.dirname(__file__), 'font', 'FiraMono-Medium.otf')
-        try:
-            font = ImageFont.truetype(font=font_path,
-                        size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
-        except OSError:
-            # Fallback to default font if custom font is not available
-            print("Warning: Could not load the specified font. Using default font.")
-            font = ImageFont.load_default()
+        for i, image in enumerate(images):
+            buffer.put(i, image)
+        if not normalize:
+            return buffer.images[:len(images)]
+        return buffer.normalized(len(images))
+
+    def _decode(self, yolo_outputs, images):
+        """
+        Decode raw model outputs for a batch of images with the traced decoder
+        for the current input size, built on first use and cached.
+
+        With backend='numpy', decoding and NMS run in NumPy on the predicted
+        arrays directly, avoiding TensorFlow dispatch for small batches.
+
+        Returns:
+          list of (out_boxes, out_scores, out_classes) numpy arrays, one per image
+        """
+        if self.backend == 'numpy':
+            return [yolo_eval_np([out[b:b + 1] for out in yolo_outputs], self.anchors,
+                        len(self.class_names), (image.size[1], image.size[0]),
+                        score_threshold=self.score, iou_threshold=self.iou)
+                    for b, image in enumerate(images)]
+
+        input_shape = tuple(int(d) * 32 for d in yolo_outputs[0].shape[1:3])
+        boxes, scores, classes, valid = self._decoder(input_shape)(
+            [tf.convert_to_tensor(out, dtype=tf.float32) for out in yolo_outputs],
+            tf.constant(self._image_shapes(images)))
+        boxes, scores, classes, valid = boxes.numpy(), scores.numpy(), classes.numpy(), valid.numpy()
+
+        return [(boxes[b, :n], scores[b, :n], classes[b, :n]) for b, n in enumerate(valid)]
+
+    @staticmethod
+    def _image_shapes(images):
+        """(n_images, 2) float32 array of original image (h, w)"""
+        return np.array([[image.size[1], image.size[0]] for image in images], dtype='float32')
+
+    def _predict(self, images, boxed_size):
+        """
+        Letterbox images to boxed_size, run the model and decode the outputs.
+        With end_to_end, uint8 images go straight into the detector model and
+        the host never converts them to float.
+
+        Returns:
+          list of (out_boxes, out_scores, out_classes) numpy arrays, one per image
+        """
+        if self.end_to_end:
+            boxes, scores, classes, valid = self._detector(boxed_size).predict_on_batch(
+                [self._letterbox(images, boxed_size, normalize=False), self._image_shapes(images)])
+            boxes, scores, classes, valid = [np.asarray(x) for x in (boxes, scores, classes, valid)]
+            return [(boxes[b, :n], scores[b, :n], classes[b, :n]) for b, n in enumerate(valid)]
+
+        image_data = self._letterbox(images, boxed_size)
+        yolo_outputs = self.yolo_model.predict_on_batch(image_data)
+        return self._decode(yolo_outputs, images)
+
+    def predict_batch(self, images, batch_size=8):
+        """
+        Run detection on a list of PIL images, batch_size images per forward pass.
 
+        Images are bucketed by network input size so that each batch is
+        letterboxed into a single (batch_size, H, W, 3) tensor. Boxes are
+        decoded separately for each image against its own original shape.
+
+        Args:
+          images: list of PIL images
+          batch_size: number of images per call to the Keras model
+        Returns:
+          list of (out_boxes, out_scores, out_classes) tuples, one for each
+            input image, as returned by predict_boxes
+        """
+        buckets = {}
+        for i, image in enumerate(images):
+            buckets.setdefault(self._boxed_image_size(image), []).append(i)
+
+        predictions = [None] * len(images)
+        for boxed_size, indices in buckets.items():
+            for i in range(0, len(indices), batch_size):
+                batch_indices = indices[i:i + batch_size]
+                batch = [images[j] for j in batch_indices]
+                for j, prediction in zip(batch_indices, self._predict(batch, boxed_size)):
+                    predictions[j] = prediction
+
+        return predictions
+
+    def detect_images(self, images, batch_size=8):
+        """
+        Batched version of detect_image, without drawing.
+
+        Returns:
+          out_boxes_list: list of (n_boxes, 4) arrays in (top, left, bottom, right)
+            format, one for each input image, as returned by detect_image
+        """
+        return [boxes for boxes, scores, classes in self.predict_batch(images, batch_size)]
+
+    def predict_boxes(self, image):
+        """
+        Run detection on a PIL image and return the raw predictions, without
+        loading fonts, drawing on the image or printing anything.
+
+        Returns:
+          out_boxes: (n_boxes, 4) array in (top, left, bottom, right) format
+          out_scores: (n_boxes,) array of confidence scores
+          out_classes: (n_boxes,) array of class indices
+        """
+        return self._predict([image], self._boxed_image_size(image))[0]
+
+    def predict_tiled(self, image, tile_size=None, overlap=0.2, batch_size=8, include_full=True):
+        """
+        Run detection on overlapping tiles of a large PIL image, so that small
+        logos are not shrunk away by letterboxing the whole image.
+
+        Tiles are batch-inferred with predict_batch, boxes are shifted back to
+        image coordinates and duplicates across tile seams are merged with
+        per-class NMS. Images no larger than one tile go through predict_boxes.
+
+        Args:
+          image: PIL image
+          tile_size: tile side in image pixels, defaults to the network input size
+          overlap: fractional overlap between neighbouring tiles
+          batch_size: number of tiles per forward pass
+          include_full: also run on the whole letterboxed image, to keep logos
+            larger than a tile
+        Returns:
+          out_boxes, out_scores, out_classes: as returned by predict_boxes
+        """
+        if tile_size is None:
+            tile_size = max(self.model_image_size) if self.model_image_size != (None, None) else 416
+        if max(image.size) <= tile_size:
+            return self.predict_boxes(image)
+
+        windows = tile_windows(image.size, tile_size, overlap)
+        tiles = [image.crop(window) for window in windows]
+        if include_full:
+            windows.append((0, 0) + image.size)
+            tiles.append(image)
+
+        boxes, scores, classes = [], [], []
+        for (left, top, _, _), (out_boxes, out_scores, out_classes) in zip(
+                windows, self.predict_batch(tiles, batch_size)):
+            boxes.append(out_boxes + np.array([top, left, top, left], dtype=out_boxes.dtype))
+            scores.append(out_scores)
+            classes.append(out_classes)
+        boxes = np.concatenate(boxes)
+        scores = np.concatenate(scores)
+        classes = np.concatenate(classes)
+
+        keep = []
+        for c in np.unique(classes):
+            class_index = np.flatnonzero(classes == c)
+            nms_index = non_max_suppression(boxes[class_index], scores[class_index],
+                                            len(class_index), self.iou)
+            keep.append(class_index[nms_index])
+        keep = np.concatenate(keep) if keep else np.array([], dtype='int32')
+
+        return boxes[keep], scores[keep], classes[keep]
+
+    def draw_boxes(self, image, out_boxes, out_scores, out_classes, verbose=False):
+        """
+        Draw predicted boxes and class labels on a PIL image, in place.
+
+        Args:
+          image: PIL image the predictions were made on
+          out_boxes, out_scores, out_classes: outputs of predict_boxes
+          verbose: print each label and box
+        Returns:
+          image: annotated PIL image
+        """
+        font = annotation_font(image)
         thickness = (image.size[0] + image.size[1]) // 300
+        draw = ImageDraw.Draw(image)
 
         for i, c in reversed(list(enumerate(out_classes))):
             predicted_class = self.class_names[c]
@@ -146,7 +352,6 @@ class YOLO(object):
             score = out_scores[i]
 
             label = '{} {:.2f}'.format(predicted_class, score)
-            draw = ImageDraw.Draw(image)
             label_size = draw.textsize(label, font)
 
             top, left, bottom, right = box
@@ -154,7 +359,8 @@ class YOLO(object):
             left = max(0, np.floor(left + 0.5).astype('int32'))
             bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
             right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
-            print(label, (left, top), (right, bottom))
+            if verbose:
+                print(label, (left, top), (right, bottom))
 
             if top - label_size[1] >= 0:
                 text_origin = np.array([left, top - label_size[1]])
@@ -170,7 +376,17 @@ class YOLO(object):
                 [tuple(text_origin), tuple(text_origin + label_size)],
                 fill=self.colors[c])
             draw.text(tuple(text_origin), label, fill=(0, 0, 0), font=font)
-            del draw
+        del draw
+
+        return image
+
+    def detect_image(self, image):
+        start = timer()
+
+        out_boxes, out_scores, out_classes = self.predict_boxes(image)
+        print('Found {} boxes for {}'.format(len(out_boxes), 'img'))
+
+        image = self.draw_boxes(image, out_boxes, out_scores, out_classes, verbose=True)
 
         end = timer()
         print('Detection time: {:.2f}s'.format(end - start))
@@ -5,7 +5,7 @@ from functools import wraps
 import numpy as np
 import tensorflow as tf
 from keras import backend as K
-from keras.layers import Conv2D, Add, ZeroPadding2D, UpSampling2D, Concatenate, MaxPooling2D
+from keras.layers import Conv2D, Add, ZeroPadding2D, UpSampling2D, Concatenate, MaxPooling2D, Input, Lambda
 from keras.layers.advanced_activations import LeakyReLU
 from keras.layers.normalization import BatchNormalization
 from keras.models import Model
@@ -207,17 +207,31 @@ def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
     return boxes
 
 
-def yolo_boxes_and_scores(feats, anchors, num_classes, input_shape, image_shape):
-    '''Process Conv layer output'''
+def yolo_boxes_and_scores(feats, anchors, num_classes, input_shape, image_shape,
+                          score_threshold=None):
+    '''Process Conv layer output
+
+    If score_threshold is given, only boxes with at least one class score above
+    it are corrected and returned.
+    '''
     input_shape = tf.cast(input_shape, tf.float32)
     image_shape = tf.cast(image_shape, tf.float32)
     
     box_xy, box_wh, box_confidence, box_class_probs = yolo_head(feats,
         anchors, num_classes, input_shape)
-    boxes = yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape)
-    boxes = tf.reshape(boxes, [-1, 4])
+    box_xy = tf.reshape(box_xy, [-1, 2])
+    box_wh = tf.reshape(box_wh, [-1, 2])
     box_scores = box_confidence * box_class_probs
     box_scores = tf.reshape(box_scores, [-1, num_classes])
+
+    # drop low-score boxes before correcting them, most anchors never pass
+    if score_threshold is not None:
+        keep = tf.reduce_max(box_scores, axis=-1) >= score_threshold
+        box_xy = tf.boolean_mask(box_xy, keep)
+        box_wh = tf.boolean_mask(box_wh, keep)
+        box_scores = tf.boolean_mask(box_scores, keep)
+
+    boxes = yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape)
     return boxes, box_scores
 
 
@@ -248,7 +262,7 @@ def yolo_eval(yolo_outputs,
     for l in range(num_layers):
         layer_anchors = tf.gather(anchors, anchor_mask[l])
         _boxes, _box_scores = yolo_boxes_and_scores(yolo_outputs[l],
-            layer_anchors, num_classes, input_shape, image_shape)
+            layer_anchors, num_classes, input_shape, image_shape, score_threshold)
         boxes.append(_boxes)
         box_scores.append(_box_scores)
     
@@ -285,6 +299,166 @@ def yolo_eval(yolo_outputs,
     return boxes_, scores_, classes_
 
 
+def yolo_decoder(anchors,
+                 num_classes,
+                 input_shape,
+                 max_boxes=20,
+                 score_threshold=.6,
+                 iou_threshold=.5):
+    """Build a traced decode function for a fixed input_shape and num_classes.
+
+    Grid offsets and per-layer anchors are computed once here as constants, and
+    decoding, letterbox correction and NMS for the whole batch run in a single
+    tf.function graph. Letterbox correction is only done for the boxes with a
+    class score above score_threshold. The per-class NMS loop of yolo_eval is
+    replaced by tf.image.combined_non_max_suppression.
+
+    Parameters
+    ----------
+    anchors: array, shape=(N, 2), wh
+    num_classes: integer
+    input_shape: (h, w) of the model input, multiples of 32
+
+    Returns
+    -------
+    decode: function (yolo_outputs, image_shapes) -> (boxes, scores, classes, valid),
+        where image_shapes is a (batch, 2) array of original image (h, w), boxes
+        is (batch, max_total, 4) in (top, left, bottom, right) format and the
+        first valid[b] rows of each output are the detections of image b.
+
+    """
+    num_layers = len(anchors)//3 # default setting
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]]
+    input_shape = np.array(input_shape, dtype='float32')
+    anchors = np.array(anchors, dtype='float32')
+
+    grids, layer_anchors, grid_whs, specs = [], [], [], []
+    for l in range(num_layers):
+        grid_h, grid_w = (input_shape // {0:32, 1:16, 2:8}[l]).astype('int32')
+        grid_x, grid_y = np.meshgrid(np.arange(grid_w), np.arange(grid_h))
+        grids.append(tf.constant(np.stack([grid_x, grid_y], axis=-1)[:, :, None, :],
+                                 dtype=tf.float32))
+        layer_anchors.append(tf.constant(anchors[anchor_mask[l]] / input_shape[::-1]))
+        grid_whs.append(tf.constant([grid_w, grid_h], dtype=tf.float32))
+        specs.append(tf.TensorSpec([None, grid_h, grid_w, len(anchor_mask[l])*(num_classes+5)],
+                                   tf.float32))
+
+    input_hw = tf.constant(input_shape)
+    max_total = max_boxes * num_classes
+
+    @tf.function(input_signature=[specs, tf.TensorSpec([None, 2], tf.float32)])
+    def decode(yolo_outputs, image_shapes):
+        batch = tf.shape(image_shapes)[0]
+
+        box_yx, box_hw, box_scores = [], [], []
+        for l in range(num_layers):
+            feats = tf.reshape(yolo_outputs[l],
+                [-1] + grids[l].shape[:2].as_list() + [len(anchor_mask[l]), num_classes + 5])
+            box_xy = (tf.sigmoid(feats[..., :2]) + grids[l]) / grid_whs[l]
+            box_wh = tf.exp(feats[..., 2:4]) * layer_anchors[l]
+            scores = tf.sigmoid(feats[..., 4:5]) * tf.sigmoid(feats[..., 5:])
+            box_yx.append(tf.reshape(box_xy[..., ::-1], [batch, -1, 2]))
+            box_hw.append(tf.reshape(box_wh[..., ::-1], [batch, -1, 2]))
+            box_scores.append(tf.reshape(scores, [batch, -1, num_classes]))
+        box_yx = tf.concat(box_yx, axis=1)
+        box_hw = tf.concat(box_hw, axis=1)
+        box_scores = tf.concat(box_scores, axis=1)
+
+        # undo letterboxing only for boxes with a class score above threshold,
+        # most anchors never pass; the other boxes stay zero and are dropped by
+        # the score threshold of the NMS
+        keep = tf.where(tf.reduce_max(box_scores, axis=-1) >= score_threshold)
+        kept_yx = tf.gather_nd(box_yx, keep)
+        kept_hw = tf.gather_nd(box_hw, keep)
+        image_hw = tf.gather(image_shapes, keep[:, 0])
+        min_scale = tf.reduce_min(input_hw / image_hw, axis=-1, keepdims=True)
+        new_shape = tf.round(image_hw * min_scale)
+        offset = (input_hw - new_shape) / 2. / input_hw
+        scale = input_hw / new_shape
+        kept_yx = (kept_yx - offset) * scale
+        kept_hw = kept_hw * scale
+        kept_boxes = tf.concat([kept_yx - kept_hw / 2., kept_yx + kept_hw / 2.], axis=-1)
+        kept_boxes = kept_boxes * tf.tile(image_hw, [1, 2])
+        boxes = tf.scatter_nd(keep, kept_boxes, tf.concat([tf.shape(box_yx, out_type=tf.int64)[:2], [4]], 0))
+
+        nms = tf.image.combined_non_max_suppression(
+            boxes[:, :, None, :], box_scores, max_boxes, max_total,
+            iou_threshold=iou_threshold, score_threshold=score_threshold,
+            clip_boxes=False)
+        return (nms.nmsed_boxes, nms.nmsed_scores,
+                tf.cast(nms.nmsed_classes, tf.int32), nms.valid_detections)
+
+    return decode
+
+
+def letterbox_tensor(images, size):
+    """Graph version of letterbox_image for a (batch, H, W, 3) float tensor in [0, 1].
+
+    Resizes with unchanged aspect ratio to fit size=(h, w) and pads with the
+    same gray (128/255) as letterbox_image.
+    """
+    h, w = size
+    image_hw = tf.cast(tf.shape(images)[1:3], tf.float32)
+    scale = tf.reduce_min(tf.constant([h, w], dtype=tf.float32) / image_hw)
+    nh, nw = tf.unstack(tf.cast(image_hw * scale, tf.int32))
+
+    images = tf.image.resize(images, tf.stack([nh, nw]), method='bicubic')
+    gray = 128. / 255.
+    images = tf.image.pad_to_bounding_box(images - gray, (h - nh)//2, (w - nw)//2, h, w) + gray
+    return images
+
+
+def yolo_detector(yolo_model,
+                  anchors,
+                  num_classes,
+                  input_shape,
+                  max_boxes=20,
+                  score_threshold=.6,
+                  iou_threshold=.5,
+                  embed_letterbox=False):
+    """Wrap a YOLO body into a single Keras model returning final detections.
+
+    Scaling to [0, 1], and optionally letterboxing, happen inside the model,
+    followed by the yolo_decoder decode and NMS, so one predict() call maps
+    raw uint8 images to boxes and the whole detector can be saved as one
+    SavedModel.
+
+    Parameters
+    ----------
+    yolo_model: output of yolo_body or tiny_yolo_body
+    input_shape: (h, w) of the model input, multiples of 32
+    embed_letterbox: if True, the model takes a batch of same-size raw images
+        of any size and letterboxes them itself. Otherwise it takes images
+        already letterboxed to input_shape, plus their original (h, w).
+
+    Returns
+    -------
+    model: Keras model with inputs uint8 images [, (batch, 2) image shapes]
+        and outputs (boxes, scores, classes, valid) as in yolo_decoder
+
+    """
+    decode = yolo_decoder(anchors, num_classes, input_shape, max_boxes,
+                          score_threshold, iou_threshold)
+
+    if embed_letterbox:
+        image_input = Input(shape=(None, None, 3), dtype='uint8')
+        image_shape = Lambda(lambda x: tf.tile(
+            tf.cast(tf.shape(x)[1:3], tf.float32)[None], [tf.shape(x)[0], 1]))(image_input)
+        inputs = image_input
+    else:
+        image_input = Input(shape=tuple(input_shape) + (3,), dtype='uint8')
+        image_shape = Input(shape=(2,), dtype='float32')
+        inputs = [image_input, image_shape]
+
+    x = Lambda(lambda x: tf.cast(x, tf.float32) / 255.)(image_input)
+    if embed_letterbox:
+        x = Lambda(lambda x: letterbox_tensor(x, input_shape))(x)
+    yolo_outputs = yolo_model(x)
+
+    detections = Lambda(lambda x: decode(x[:-1], x[-1]))(list(yolo_outputs) + [image_shape])
+    return Model(inputs, detections)
+
+
 def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     '''Preprocess true boxes to training input format
 
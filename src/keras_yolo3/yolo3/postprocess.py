@@ -0,0 +1,192 @@
+"""YOLO_v3 output decoding and NMS in pure NumPy, for CPU-only inference."""
+
+from functools import lru_cache
+
+import numpy as np
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+@lru_cache(maxsize=None)
+def _grid(grid_h, grid_w):
+    '''(grid_h, grid_w, 1, 2) array of xy cell offsets, cached per grid size'''
+    grid_x, grid_y = np.meshgrid(np.arange(grid_w), np.arange(grid_h))
+    return np.stack([grid_x, grid_y], axis=-1)[:, :, None, :].astype('float32')
+
+
+def yolo_head_np(feats, anchors, num_classes, input_shape):
+    """NumPy version of yolo_head for a single image.
+
+    Parameters
+    ----------
+    feats: array, shape=(1, grid_h, grid_w, num_anchors*(num_classes+5))
+    anchors: array, shape=(num_anchors, 2), wh
+    num_classes: integer
+    input_shape: (h, w) of the model input
+
+    Returns
+    -------
+    box_xy, box_wh, box_confidence, box_class_probs: arrays of shape
+        (grid_h, grid_w, num_anchors, ...), xywh relative to input_shape
+
+    """
+    grid_h, grid_w = feats.shape[1:3]
+    feats = feats.reshape(grid_h, grid_w, len(anchors), num_classes + 5)
+
+    box_xy = (sigmoid(feats[..., :2]) + _grid(grid_h, grid_w)) / np.array([grid_w, grid_h], dtype='float32')
+    box_wh = np.exp(feats[..., 2:4]) * anchors / np.array(input_shape[::-1], dtype='float32')
+    box_confidence = sigmoid(feats[..., 4:5])
+    box_class_probs = sigmoid(feats[..., 5:])
+    return box_xy, box_wh, box_confidence, box_class_probs
+
+
+def yolo_correct_boxes_np(box_xy, box_wh, input_shape, image_shape):
+    '''NumPy version of yolo_correct_boxes: undo letterboxing, return
+    (..., 4) boxes as (top, left, bottom, right) in image pixels'''
+    input_shape = np.array(input_shape, dtype='float32')
+    image_shape = np.array(image_shape, dtype='float32')
+
+    box_yx = box_xy[..., ::-1]
+    box_hw = box_wh[..., ::-1]
+
+    min_scale = np.min(input_shape/image_shape)
+    new_shape = np.round(image_shape * min_scale)
+    offset = (input_shape-new_shape)/2./input_shape
+    scale = input_shape/new_shape
+
+    box_yx = (box_yx - offset) * scale
+    box_hw = box_hw * scale
+
+    boxes = np.concatenate([box_yx - box_hw/2., box_yx + box_hw/2.], axis=-1)
+    return boxes * np.concatenate([image_shape, image_shape])
+
+
+@lru_cache(maxsize=None)
+def _flat_grid(grid_h, grid_w, num_anchors):
+    '''(grid_h*grid_w*num_anchors, 2) xy cell offsets, in the order of a flattened yolo output'''
+    return np.broadcast_to(_grid(grid_h, grid_w), (grid_h, grid_w, num_anchors, 2)).reshape(-1, 2)
+
+
+def yolo_boxes_and_scores_np(feats, anchors, num_classes, input_shape, image_shape,
+                             score_threshold=None):
+    """Decode one output layer of a single image into boxes and class scores.
+
+    Scores are computed first from the raw objectness and class logits; if
+    score_threshold is given, xywh decoding and letterbox correction are only
+    done for the boxes with at least one class score above it.
+
+    Returns
+    -------
+    boxes: array, shape=(n, 4), (top, left, bottom, right)
+    box_scores: array, shape=(n, num_classes)
+
+    """
+    grid_h, grid_w = feats.shape[1:3]
+    num_anchors = len(anchors)
+    feats = feats.reshape(-1, num_classes + 5)
+
+    box_scores = sigmoid(feats[:, 4:5]) * sigmoid(feats[:, 5:])
+    grid = _flat_grid(grid_h, grid_w, num_anchors)
+    box_anchors = np.tile(anchors, (grid_h * grid_w, 1))
+
+    if score_threshold is not None:
+        keep = np.flatnonzero(box_scores.max(axis=-1) >= score_threshold)
+        feats, box_scores = feats[keep], box_scores[keep]
+        grid, box_anchors = grid[keep], box_anchors[keep]
+
+    box_xy = (sigmoid(feats[:, :2]) + grid) / np.array([grid_w, grid_h], dtype='float32')
+    box_wh = np.exp(feats[:, 2:4]) * box_anchors / np.array(input_shape[::-1], dtype='float32')
+    boxes = yolo_correct_boxes_np(box_xy, box_wh, input_shape, image_shape)
+    return boxes, box_scores
+
+
+def non_max_suppression(boxes, scores, max_boxes, iou_threshold):
+    """Greedy NMS with the same semantics as tf.image.non_max_suppression.
+
+    Parameters
+    ----------
+    boxes: array, shape=(n, 4), (top, left, bottom, right)
+    scores: array, shape=(n,)
+    max_boxes: maximum number of boxes to keep
+    iou_threshold: boxes overlapping a kept box by more than this are dropped
+
+    Returns
+    -------
+    keep: array of indices of kept boxes, by decreasing score
+
+    """
+    order = np.argsort(-scores, kind='stable')
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    keep = []
+    while order.size > 0 and len(keep) < max_boxes:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+
+        intersect_mins = np.maximum(boxes[i, :2], boxes[rest, :2])
+        intersect_maxes = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        intersect_wh = np.maximum(intersect_maxes - intersect_mins, 0.)
+        intersect_area = intersect_wh[:, 0] * intersect_wh[:, 1]
+        union = areas[i] + areas[rest] - intersect_area
+        with np.errstate(divide='ignore', invalid='ignore'):
+            iou = np.where(union > 0, intersect_area / union, 0.)
+
+        order = rest[iou <= iou_threshold]
+
+    return np.array(keep, dtype='int32')
+
+
+def yolo_eval_np(yolo_outputs,
+                 anchors,
+                 num_classes,
+                 image_shape,
+                 max_boxes=20,
+                 score_threshold=.6,
+                 iou_threshold=.5):
+    """NumPy version of yolo_eval for the outputs of a single image.
+
+    Parameters
+    ----------
+    yolo_outputs: list of arrays, shape=(1, grid_h, grid_w, ...), as returned
+        by the Keras model predict()
+    anchors: array, shape=(N, 2), wh
+    num_classes: integer
+    image_shape: (h, w) of the original image
+
+    Returns
+    -------
+    boxes: array, shape=(n, 4), (top, left, bottom, right)
+    scores: array, shape=(n,)
+    classes: array, shape=(n,)
+
+    """
+    num_layers = len(yolo_outputs)
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]] # default setting
+    anchors = np.array(anchors, dtype='float32')
+    input_shape = tuple(d * 32 for d in yolo_outputs[0].shape[1:3])
+
+    boxes = []
+    box_scores = []
+    for l in range(num_layers):
+        _boxes, _box_scores = yolo_boxes_and_scores_np(
+            np.asarray(yolo_outputs[l], dtype='float32'), anchors[anchor_mask[l]],
+            num_classes, input_shape, image_shape, score_threshold)
+        boxes.append(_boxes)
+        box_scores.append(_box_scores)
+    boxes = np.concatenate(boxes, axis=0)
+    box_scores = np.concatenate(box_scores, axis=0)
+
+    boxes_, scores_, classes_ = [], [], []
+    for c in range(num_classes):
+        mask = box_scores[:, c] >= score_threshold
+        class_boxes = boxes[mask]
+        class_box_scores = box_scores[mask, c]
+
+        nms_index = non_max_suppression(class_boxes, class_box_scores, max_boxes, iou_threshold)
+        boxes_.append(class_boxes[nms_index])
+        scores_.append(class_box_scores[nms_index])
+        classes_.append(np.full(len(nms_index), c, dtype='int32'))
+
+    return np.concatenate(boxes_), np.concatenate(scores_), np.concatenate(classes_)
@@ -0,0 +1,84 @@
+"""Parity of the NumPy decoding backend with the TensorFlow decoders."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+tf = pytest.importorskip('tensorflow')
+model = pytest.importorskip('keras_yolo3.yolo3.model')
+from keras_yolo3.yolo3.postprocess import yolo_eval_np
+
+YOLO_ANCHORS = np.array([[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119],
+                         [116, 90], [156, 198], [373, 326]], dtype='float32')
+TINY_ANCHORS = np.array([[10, 14], [23, 27], [37, 58], [81, 82], [135, 169], [344, 319]],
+                        dtype='float32')
+NUM_CLASSES = 3
+SCORE_THRESHOLD = .3
+IOU_THRESHOLD = .45
+
+
+def random_outputs(anchors, input_shape, seed):
+    '''random raw outputs of a yolo body for one image of input_shape (h, w)'''
+    rng = np.random.RandomState(seed)
+    num_layers = len(anchors)//3
+    return [rng.normal(scale=2., size=(1, input_shape[0]//stride, input_shape[1]//stride,
+                                       3*(NUM_CLASSES+5))).astype('float32')
+            for stride in [32, 16, 8][:num_layers]]
+
+
+def sorted_detections(boxes, scores, classes):
+    '''detections ordered by class then decreasing score, as NMS order differs'''
+    boxes, scores, classes = np.asarray(boxes), np.asarray(scores), np.asarray(classes)
+    order = np.lexsort((-scores, classes))
+    return boxes[order], scores[order], classes[order]
+
+
+def assert_same_detections(expected, actual):
+    boxes, scores, classes = sorted_detections(*expected)
+    boxes_np, scores_np, classes_np = sorted_detections(*actual)
+    assert len(scores) > 0, 'random outputs should give some detections'
+    np.testing.assert_array_equal(classes_np, classes)
+    np.testing.assert_allclose(scores_np, scores, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(boxes_np, boxes, rtol=1e-4, atol=1e-2)
+
+
+@pytest.mark.parametrize('anchors', [YOLO_ANCHORS, TINY_ANCHORS], ids=['yolo', 'tiny'])
+@pytest.mark.parametrize('input_shape,image_shape', [
+    ((416, 416), (416, 416)),
+    ((416, 416), (300, 500)),
+    ((320, 416), (480, 640)),
+])
+def test_yolo_eval_np_matches_yolo_eval(anchors, input_shape, image_shape):
+    yolo_outputs = random_outputs(anchors, input_shape, seed=0)
+
+    expected = model.yolo_eval([tf.constant(out) for out in yolo_outputs], anchors, NUM_CLASSES,
+                               tf.constant(image_shape, dtype=tf.float32), max_boxes=20,
+                               score_threshold=SCORE_THRESHOLD, iou_threshold=IOU_THRESHOLD)
+    actual = yolo_eval_np(yolo_outputs, anchors, NUM_CLASSES, image_shape, max_boxes=20,
+                          score_threshold=SCORE_THRESHOLD, iou_threshold=IOU_THRESHOLD)
+
+    assert_same_detections([t.numpy() for t in expected], actual)
+
+
+@pytest.mark.parametrize('anchors', [YOLO_ANCHORS, TINY_ANCHORS], ids=['yolo', 'tiny'])
+@pytest.mark.parametrize('input_shape,image_shape', [
+    ((416, 416), (300, 500)),
+    ((320, 416), (480, 640)),
+])
+def test_yolo_eval_np_matches_yolo_decoder(anchors, input_shape, image_shape):
+    yolo_outputs = random_outputs(anchors, input_shape, seed=1)
+
+    decode = model.yolo_decoder(anchors, NUM_CLASSES, input_shape, max_boxes=20,
+                                score_threshold=SCORE_THRESHOLD, iou_threshold=IOU_THRESHOLD)
+    boxes, scores, classes, valid = decode([tf.constant(out) for out in yolo_outputs],
+                                           tf.constant([image_shape], dtype=tf.float32))
+    n = int(valid[0])
+    expected = boxes[0, :n].numpy(), scores[0, :n].numpy(), classes[0, :n].numpy()
+    actual = yolo_eval_np(yolo_outputs, anchors, NUM_CLASSES, image_shape, max_boxes=20,
+                          score_threshold=SCORE_THRESHOLD, iou_threshold=IOU_THRESHOLD)
+
+    assert_same_detections(expected, actual)
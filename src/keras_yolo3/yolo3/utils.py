@@ -1,11 +1,16 @@
 """Miscellaneous utility functions."""
 
-from functools import reduce
+import colorsys
+from functools import lru_cache, reduce
+import os
 
-from PIL import Image
+import cv2
+from PIL import Image, ImageFont
 import numpy as np
 from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
 
+FONT_PATH = os.path.join(os.path.dirname(__file__), os.path.pardir, 'font', 'FiraMono-Medium.otf')
+
 def compose(*funcs):
     """Compose arbitrarily many functions, evaluated left to right.
 
@@ -30,6 +35,112 @@ def letterbox_image(image, size):
     new_image.paste(image, ((w-nw)//2, (h-nh)//2))
     return new_image
 
+def input_size_for_image(image_size, min_logo_size, min_object_size=8, size_range=(320, 608)):
+    '''Pick a square network input size for an image of image_size (w, h).
+
+    Returns the smallest multiple of 32 at which a logo of min_logo_size pixels
+    in the original image still spans min_object_size pixels after
+    letterboxing (one cell of the finest YOLO grid), clipped to size_range.
+    Thumbnails get the smallest size, large images the largest.
+    '''
+    size = max(image_size) * min_object_size / min_logo_size
+    size = int(np.ceil(size / 32.)) * 32
+    return int(np.clip(size, *size_range))
+
+def tile_windows(image_size, tile_size, overlap=0.2):
+    '''Split an image of image_size (w, h) into overlapping square tiles.
+
+    Tiles are tile_size wide and step by tile_size*(1-overlap); the last row and
+    column are shifted back to end at the image border, so all tiles have the
+    same size unless the image is smaller than tile_size.
+
+    Returns list of (left, top, right, bottom) windows.
+    '''
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+    w, h = image_size
+    return [(x, y, min(x + tile_size, w), min(y + tile_size, h))
+            for y in starts(h) for x in starts(w)]
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    '''Load the annotation font at the given size, cached process-wide'''
+    try:
+        return ImageFont.truetype(font=FONT_PATH, size=int(size))
+    except OSError:
+        # Fallback to default font if custom font is not available
+        print("Warning: Could not load the specified font. Using default font.")
+        return ImageFont.load_default()
+
+def annotation_font(image):
+    '''Font for box labels, sized to 3% of the image height'''
+    return load_font(int(np.floor(3e-2 * image.size[1] + 0.5)))
+
+@lru_cache(maxsize=None)
+def class_colors(n):
+    '''n distinct RGB integer tuples, computed once per n.
+
+    Colors are shuffled to decorrelate adjacent classes with a private RNG,
+    seeded as before for consistent colors across runs, so the global NumPy
+    random state is left untouched.
+    '''
+    hsv_tuples = [(x / n, 1., 1.) for x in range(n)]
+    colors = [tuple(int(c * 255) for c in colorsys.hsv_to_rgb(*x)) for x in hsv_tuples]
+    np.random.RandomState(10101).shuffle(colors)
+    return tuple(colors)
+
+class LetterboxBatch(object):
+    '''Reusable letterbox buffers for batches of images of one input size.
+
+    Images are resized with OpenCV straight into a preallocated uint8
+    (batch_size, h, w, 3) buffer. The gray padding is only refilled when the
+    layout of a slot changes, and scaling to [0, 1] is done for the whole batch
+    in one vectorized op into a preallocated float32 buffer.
+    '''
+
+    def __init__(self, batch_size, size):
+        w, h = size
+        self.size = size
+        self.images = np.full((batch_size, h, w, 3), 128, dtype='uint8')
+        self.data = np.empty(self.images.shape, dtype='float32')
+        self._windows = [None] * batch_size
+
+    def put(self, index, image):
+        '''letterbox image (PIL image or (H, W[, C]) RGB array) into slot index'''
+        if isinstance(image, Image.Image) and image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = image[:, :, None]
+        if image.shape[2] == 1:
+            image = np.repeat(image, 3, axis=2)
+        image = image[:, :, :3]
+        ih, iw = image.shape[:2]
+        w, h = self.size
+        scale = min(w/iw, h/ih)
+        nw = int(iw*scale)
+        nh = int(ih*scale)
+        dx, dy = (w-nw)//2, (h-nh)//2
+
+        if self._windows[index] != (dx, dy, nw, nh):
+            self.images[index].fill(128)
+            self._windows[index] = (dx, dy, nw, nh)
+        # cubic does not antialias: area averaging when downsizing
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        self.images[index, dy:dy+nh, dx:dx+nw] = cv2.resize(image, (nw, nh),
+                                                            interpolation=interpolation)
+
+    def normalized(self, n=None):
+        '''first n letterboxed images as float32 in [0, 1], ready for the model'''
+        n = len(self.images) if n is None else n
+        np.multiply(self.images[:n], np.float32(1/255.), out=self.data[:n], dtype='float32')
+        return self.data[:n]
+
 def rand(a=0, b=1):
     return np.random.rand()*(b-a) + a
 
@@ -1,4 +1,5 @@
 import cv2
+import numpy as np
 from keras import Model
 
 import metrics
@@ -61,10 +62,21 @@ def extract_litw_features(filename, model, my_preprocess):
 
     return features, all_logos, brand_map
 
+def feature_map_shape(model, n_features):
+    """
+    (H, W, C) of the output of a feature extractor, given the length of its
+    flattened output. Models built for any input size have no fixed H and W:
+    their feature map is then square.
+    """
+    h, w, c = model.output_shape[1:]
+    if h is None or w is None:
+        h = w = int(round(np.sqrt(n_features // c)))
+    return h, w, c
+
 if __name__ == '__main__':
 
     model, preprocess_input, input_shape = utils.load_extractor_model('InceptionV3', flavor=0)
-    my_preprocess = lambda x: preprocess_input(utils.pad_image(x, input_shape))
+    my_preprocess = utils.CropPreprocess(preprocess_input, input_shape)
 
     print('Extracting features from LogosInTheWild database (train set) - this will take a while (~5 minutes)')
     features, all_logos, brand_map = extract_litw_features('data_all_train.txt', model, my_preprocess)
@@ -77,7 +89,7 @@ if __name__ == '__main__':
     # save features for Inception with smaller input: 200 instead of 299 - last layer is 4*4 instead of 8*8
     # Extract features at last layer as well as after last 3 inception blocks (mixed9,8,7)
     input_shape = (200,200,3)
-    new_preprocess = lambda x: preprocess_input(utils.pad_image(x, input_shape))
+    new_preprocess = utils.CropPreprocess(preprocess_input, input_shape)
 
     trunc_layer = [-1, 279, 248, 228]
     for i_layer in range(4):
@@ -87,6 +99,13 @@ if __name__ == '__main__':
         extra = '_trunc{}'.format(i_layer) if i_layer > 0 else ''
         utils.save_features('inception_logo_features_200{}.hdf5'.format(extra), features, brand_map, input_shape)
 
+        # pooled variants, with much narrower feature vectors, pooled from the
+        # features above rather than by another pass of the extractor
+        map_shape = feature_map_shape(model_out, features.shape[1])
+        for pooling in utils.pooling_modes:
+            utils.save_features('inception_logo_features_200{}_{}.hdf5'.format(extra, pooling),
+                                utils.pool_features(features, map_shape, pooling), brand_map, input_shape)
+
 
     # save features for VGG16 at 3 different input scales
     from keras.applications.vgg16 import VGG16
@@ -95,6 +114,11 @@ if __name__ == '__main__':
 
     for n in [224,128,64]:
         input_shape = (n,n,3)
-        new_preprocess = lambda x: preprocess_input(utils.pad_image(x, input_shape))
+        new_preprocess = utils.CropPreprocess(preprocess_input, input_shape)
         features = utils.features_from_image(all_logos, model, new_preprocess)
         utils.save_features('vgg16_logo_features_{}.hdf5'.format(n), features, brand_map, input_shape)
+
+        map_shape = feature_map_shape(model, features.shape[1])
+        for pooling in utils.pooling_modes:
+            utils.save_features('vgg16_logo_features_{}_{}.hdf5'.format(n, pooling),
+                                utils.pool_features(features, map_shape, pooling), brand_map, input_shape)
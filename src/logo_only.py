@@ -77,6 +77,11 @@ if __name__ == '__main__':
         help='YOLO object confidence threshold above which to show predictions'
     )
 
+    parser.add_argument(
+        '--min_logo_size', type=int, default = None,
+        help='smallest logo size in pixels to preserve: if set, YOLO input size is chosen per image between 320 and 608 instead of fixed 416'
+    )
+
     FLAGS = parser.parse_args()
     save_img_logo = not FLAGS.no_save_img
 
@@ -87,6 +92,7 @@ if __name__ == '__main__':
                 "score" : FLAGS.score,
                 "gpu_num" : FLAGS.gpu_num,
                 "model_image_size" : (416, 416),
+                "min_logo_size" : FLAGS.min_logo_size,
                 }
                )
 
@@ -10,8 +10,10 @@ from PIL import Image
 from timeit import default_timer as timer
 
 from logos import detect_logo, match_logo
-from similarity import load_brands_compute_cutoffs
-from utils import load_extractor_model, load_features, model_flavor_from_name, parse_input
+from brand_registry import BrandRegistry
+from brand_search import IVFSearch
+from similarity import BrandIndex, load_brands_compute_cutoffs
+from utils import load_extractor_model, load_features, model_flavor_from_name, parse_input, pooling_from_name
 import test
 import utils
 from report_generator import create_report_from_detections
@@ -89,6 +91,11 @@ if __name__ == '__main__':
         help='YOLO object confidence threshold above which to show predictions'
     )
 
+    parser.add_argument(
+        '--min_logo_size', type=int, default = None,
+        help='smallest logo size in pixels to preserve: if set, YOLO input size is chosen per image between 320 and 608 instead of fixed 416'
+    )
+
     parser.add_argument(# good default choices: inception_logo_features_200_trunc2, vgg16_logo_features_128
         '--features', type=str, dest='features', default = 'inception_logo_features_200_trunc2.hdf5',
         help='path to LogosInTheWild logos features extracted by InceptionV3/VGG16'
@@ -99,7 +106,28 @@ if __name__ == '__main__':
         help='False positive rate target to define similarity cutoffs'
     )
 
+    parser.add_argument(
+        '--workers', type=int, default = utils.preprocess_workers,
+        help='Number of threads preprocessing logo crops for the feature extractor'
+    )
+
+    parser.add_argument(
+        '--nprobe', type=int, default = None,
+        help='Match logos with an approximate IVF brand index visiting NPROBE clusters per logo, for large brand catalogs (default = exact matching)'
+    )
+
+    parser.add_argument(
+        '--int8', default=False, action="store_true",
+        help='Store LogosInTheWild features and input brand features as int8 with per-vector scales: 4x less memory than float32, cosine similarities within about 0.003'
+    )
+
+    parser.add_argument(
+        '--brand_registry', type=str, default = None,
+        help='Path to .npz registry of input brands: only brands new or changed since the last run are featurized, and matching runs against all registered brands (default = None)'
+    )
+
     FLAGS = parser.parse_args()
+    utils.preprocess_workers = FLAGS.workers
 
     if FLAGS.test:
         test.test(FLAGS.features)
@@ -169,6 +197,7 @@ if __name__ == '__main__':
                     "score" : FLAGS.score,
                     "gpu_num" : FLAGS.gpu_num,
                     "model_image_size" : (416, 416),
+                    "min_logo_size" : FLAGS.min_logo_size,
                     }
                    )
 
@@ -180,15 +209,28 @@ if __name__ == '__main__':
         # get Inception/VGG16 model and flavor from filename
         model_name, flavor = model_flavor_from_name(FLAGS.features)
         ## load pre-processed LITW features database
-        features, brand_map, input_shape = load_features(FLAGS.features)
+        features, brand_map, input_shape = load_features(FLAGS.features, quantized=FLAGS.int8)
 
         ## load inception model
-        model, preprocess_input, input_shape = load_extractor_model(model_name, flavor)
-        my_preprocess = lambda x: preprocess_input(utils.pad_image(x, input_shape))
-
-        # compute cosine similarity between input brand images and all LogosInTheWild logos
-        ( img_input, feat_input, sim_cutoff, (bins, cdf_list)
-        ) = load_brands_compute_cutoffs(input_paths, (model, my_preprocess), features, sim_threshold)
+        model, preprocess_input, input_shape = load_extractor_model(model_name, flavor,
+                                                                    pooling=pooling_from_name(FLAGS.features))
+        my_preprocess = utils.CropPreprocess(preprocess_input, input_shape)
+
+        search = IVFSearch(nprobe=FLAGS.nprobe) if FLAGS.nprobe else None
+        dtype = 'int8' if FLAGS.int8 else 'float32'
+        if FLAGS.brand_registry:
+            # register new or changed input brands, match against all registered ones
+            registry = BrandRegistry(FLAGS.brand_registry, (model, my_preprocess), features, sim_threshold,
+                                     extractor_key=os.path.basename(FLAGS.features))
+            registry.add_brands(input_paths, input_labels)
+            brand_index = registry.index(dtype, search=search)
+            input_labels = registry.names
+        else:
+            # compute cosine similarity between input brand images and all LogosInTheWild logos
+            ( img_input, feat_input, sim_cutoff, (bins, cdf_list)
+            ) = load_brands_compute_cutoffs(input_paths, (model, my_preprocess), features, sim_threshold,
+                                          extractor_key=os.path.basename(FLAGS.features))
+            brand_index = BrandIndex(feat_input, sim_cutoff, bins, cdf_list, dtype, search=search)
 
         start = timer()
         # cycle trough input images, look for logos and then match them against inputs
@@ -210,7 +252,7 @@ if __name__ == '__main__':
             try:
                 prediction, matches, confidence_scores = match_logo(
                     image, prediction, (model, my_preprocess),
-                    text_out, (feat_input, sim_cutoff, (bins, cdf_list))
+                    text_out, brand_index
                 )
                 
                 # Add results to report data
@@ -218,9 +260,9 @@ if __name__ == '__main__':
                 
                 # Print matches
                 for idx, (logo_name, similarity) in matches.items():
-                    bb = prediction[idx]
-                    print(f'Logo #{idx} - {tuple(bb[:2])} {tuple(bb[2:4])} - classified as {logo_name} {similarity:.2f}')
-                    text_out += f' {bb[0]},{bb[1]},{bb[2]},{bb[3]},{logo_name},{bb[4]:.2f},{similarity:.3f}'
+                    top, left, bottom, right = prediction[idx][:4]
+                    print(f'Logo #{idx} - ({left:.0f}, {top:.0f}) ({right:.0f}, {bottom:.0f}) - classified as {logo_name} {similarity:.2f}')
+                    text_out += f' {left:.0f},{top:.0f},{right:.0f},{bottom:.0f},{logo_name},{confidence_scores[idx]:.2f},{similarity:.3f}'
                 
             except Exception as e:
                 print(f"Error processing matches for {img_path}: {e}")
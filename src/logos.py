@@ -6,7 +6,7 @@ from timeit import default_timer as timer
 
 import utils
 from utils import contents_of_bbox, features_from_image
-from similarity import load_brands_compute_cutoffs, similar_matches, similarity_cutoff, draw_matches
+from similarity import BrandIndex, load_brands_compute_cutoffs, similar_matches, similarity_cutoff, draw_matches
 
 
 def detect_logo(yolo, img_path, save_img, save_img_path='./', postfix=''):
@@ -20,7 +20,8 @@ def detect_logo(yolo, img_path, save_img, save_img_path='./', postfix=''):
       save_img_path: path to directory where to save image
       postfix: string to add to filenames
     Returns:
-      prediction: list of bounding boxes in format (xmin,ymin,xmax,ymax,class_id,confidence)
+      prediction: (n_boxes, 5) array of bounding boxes in (top, left, bottom, right)
+        format, as returned by YOLO.predict_boxes, followed by their confidence score
       image: unaltered input image as (H,W,C) array
     """
     try:
@@ -32,11 +33,12 @@ def detect_logo(yolo, img_path, save_img, save_img_path='./', postfix=''):
         print('File Open Error! Try again!')
         return None, None
 
-    prediction, new_image = yolo.detect_image(image)
-
-    img_out = postfix.join(os.path.splitext(os.path.basename(img_path)))
+    boxes, scores, classes = yolo.predict_boxes(image)
     if save_img:
+        new_image = yolo.draw_boxes(image, boxes, scores, classes, verbose=True)
+        img_out = postfix.join(os.path.splitext(os.path.basename(img_path)))
         new_image.save(os.path.join(save_img_path, img_out))
+    prediction = np.column_stack([np.reshape(boxes, (-1, 4)), np.reshape(scores, -1)])
 
     return prediction, image_array
 
@@ -49,46 +51,78 @@ def match_logo(img, prediction, model_preproc, text, sim_threshold, bins=100, cd
        b) computing feature vector for predicted logo
        c) finding closest input logo to predicted logo by cosine similarity
     3) if match is good enough, label prediction as input logo
+
+    Single-image wrapper around match_logos().
     """
-    model, my_preprocess = model_preproc
-    feat_input, sim_cutoff, (cdf_list, bins_list) = sim_threshold
-    
     # If no predictions or empty predictions, return empty results
     if prediction is None or len(prediction) == 0:
         return [], {}, []
-    
-    matches = {}
-    match_index = 0
+
+    return match_logos([img], [prediction], model_preproc, sim_threshold)[0]
+
+
+def match_logos(images, predictions, model_preproc, sim_threshold):
+    """
+    Match the predicted boxes of several images against the input brands.
+
+    The crops of every box of every image are gathered and featurized with a
+    single features_from_image() call, matched against the inputs at once, and
+    the results scattered back to their (image, box) indices. Boxes smaller than
+    utils.min_logo_size once clipped to the image are not matched.
+
+    Args:
+      images: list of (H,W,C) image arrays
+      predictions: list of box arrays, one per image, each box in
+        (top, left, bottom, right[, score]) format as returned by detect_logo()
+      model_preproc: (model, preprocess) tuple of model extractor and
+        image preprocessing function
+      sim_threshold: BrandIndex of the input brands, or (feat_input, sim_cutoff,
+        (bins, cdf_list)) tuple as returned by load_brands_compute_cutoffs()
+    Returns:
+      list of (prediction, matches, confidence_scores) tuples, one per image,
+        where matches maps box index in prediction to (input index, CDF value)
+    """
+    model, my_preprocess = model_preproc
+    if isinstance(sim_threshold, BrandIndex):
+        brand_index = sim_threshold
+    else:
+        brand_index = BrandIndex.from_sim_threshold(sim_threshold)
+
+    crops = []
+    owners = []
     confidence_scores = []
-    
-    for pred in prediction:
-        try:
-            # Verificar se a predição tem 4 ou 5 valores
-            if len(pred) == 4:
-                xmin, ymin, xmax, ymax = pred
-                score = 1.0  # Default score se não fornecido
-            else:
-                xmin, ymin, xmax, ymax, score = pred
-                
-            confidence_scores.append(score)
-            
-            # extract region of image corresponding to prediction
-            # and preprocess it so it can be fed to net
-            logo_img = img[int(ymin):int(ymax), int(xmin):int(xmax)]
-            if logo_img.size == 0:
+    for i_img, (img, prediction) in enumerate(zip(images, predictions)):
+        scores = []
+        for i_box, pred in enumerate(prediction if prediction is not None else []):
+            top, left, bottom, right = pred[:4]
+            # default score if not provided
+            scores.append(pred[4] if len(pred) > 4 else 1.0)
+
+            # extract region of image corresponding to prediction, boxes are not
+            # clipped and negative indices would wrap around
+            h, w = img.shape[:2]
+            top, bottom = np.clip([int(top), int(bottom)], 0, h)
+            left, right = np.clip([int(left), int(right)], 0, w)
+            # slivers left by clipping would be resized to an empty image
+            if bottom - top < utils.min_logo_size[0] or right - left < utils.min_logo_size[1]:
                 continue
-                
-            logo_feat = features_from_image(logo_img, model, my_preprocess)
-            
-            # find best match of crop among input logos
-            matches[match_index] = find_match(logo_feat, feat_input, sim_cutoff)
-            match_index += 1
-            
-        except Exception as e:
-            print(f"Error processing prediction: {e}")
-            continue
-    
-    return prediction, matches, confidence_scores
+            logo_img = img[top:bottom, left:right]
+            crops.append(logo_img)
+            owners.append((i_img, i_box))
+        confidence_scores.append(scores)
+    owners = np.array(owners, dtype=int).reshape(-1, 2)
+
+    # one extractor pass and one similarity computation for all crops
+    features_cand = features_from_image(crops, model, my_preprocess)
+    cand_matches, _ = brand_index.match(features_cand)
+
+    matches_list = [{} for _ in images]
+    for i_cand in sorted(cand_matches):
+        i_img, i_box = owners[i_cand]
+        matches_list[i_img][i_box] = cand_matches[i_cand]
+
+    return [(prediction, matches, scores) for prediction, matches, scores
+            in zip(predictions, matches_list, confidence_scores)]
 
 
 def detect_video(yolo, video_path, output_path=""):
@@ -0,0 +1,94 @@
+"""
+int8 scalar quantization of L2-normalized feature vectors, with one scale
+per vector, for the logo database and the brand features.
+"""
+import numpy as np
+
+# rows of int8 codes converted to float32 at a time in matrix products
+int8_chunk_size = 8192
+
+
+class Int8Features(object):
+    """
+    int8 codes and float32 per-vector scales of L2-normalized feature vectors:
+    vector i is approximated by codes[i] * scales[i]. Takes 4x less memory
+    than float32 and 2x less than float16.
+
+    Behaves as a read-only (n_vectors, N) array for slicing (codes, possibly
+    memory-mapped, are sliced without copy), np.asarray() (dequantized float32)
+    and products with float matrices, computed chunk by chunk so that only
+    int8_chunk_size rows are ever converted to float32.
+
+    Args:
+      codes: (n_vectors, N) int8 array
+      scales: (n_vectors,) float32 array
+    """
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = np.asarray(scales, dtype=np.float32)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return self.codes.dtype
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx):
+        if np.isscalar(idx):
+            # idx + 1 is 0 for the last row: slice to the end instead
+            idx = slice(idx, idx + 1 or None)
+        return Int8Features(self.codes[idx], self.scales[idx])
+
+    def __array__(self, dtype=None, copy=None):
+        return self.dequantize().astype(dtype or np.float32, copy=False)
+
+    def dequantize(self):
+        """
+        (n_vectors, N) float32 approximation of the vectors.
+        """
+        return self.codes.astype(np.float32) * self.scales[:, None]
+
+    def norms(self):
+        """
+        L2 norms of the dequantized vectors, within 1% of 1.
+        """
+        codes = self.codes.astype(np.float32)
+        return np.sqrt(np.einsum('ij,ij->i', codes, codes)) * self.scales
+
+    def __matmul__(self, other):
+        """
+        Product with a float (N,) or (N, m) array. Each chunk of codes is
+        converted to float32 and multiplied by other in float32 by BLAS, which
+        also accumulates the products in float32.
+        """
+        other = np.asarray(other, dtype=np.float32)
+        out = np.empty((len(self),) + other.shape[1:], dtype=np.float32)
+        for i in range(0, len(self), int8_chunk_size):
+            out[i:i+int8_chunk_size] = self.codes[i:i+int8_chunk_size].astype(np.float32) @ other
+        out *= self.scales.reshape((-1,) + (1,) * (other.ndim - 1))
+        return out
+
+
+def quantize_int8(x, normalize=True):
+    """
+    Quantize rows of a 2D array to int8 with one scale per row, mapping the
+    largest absolute component of each row to +-127.
+
+    Args:
+      x: (n_vectors, N) float array
+      normalize: L2-normalize rows before quantization
+    Returns:
+      Int8Features of x
+    """
+    x = np.asarray(x, dtype=np.float32)
+    if normalize:
+        x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+    scales = np.abs(x).max(axis=1) / 127. if x.size else np.zeros(len(x), dtype=np.float32)
+    codes = np.rint(x / np.maximum(scales, 1e-12)[:, None]).astype(np.int8)
+    return Int8Features(codes, scales)
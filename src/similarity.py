@@ -1,88 +1,298 @@
 import cv2
+import hashlib
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import os
+import zipfile
 
-from utils import bbox_colors, chunks, draw_annotated_box, features_from_image
+from brand_search import ExactSearch
+from quantization import Int8Features, quantize_int8
+from utils import bbox_colors, draw_annotated_box, extractor_cache_dir, features_from_image
 from timeit import default_timer as timer
 from PIL import Image
 
-
-def similarity_cutoff(feat_input, features, threshold=0.95, timing=False):
+# per-brand (features, cutoff, cdf) cache of load_brands_compute_cutoffs()
+cutoff_cache_dir = os.path.join(extractor_cache_dir, 'cutoffs')
+# bump when the format of cached cutoffs changes
+cutoff_cache_version = 2
+# quantile levels at which the similarity distribution of the database against
+# each brand is stored, denser in the upper tail where cutoffs and matches lie
+cdf_quantiles = np.unique(np.concatenate([np.linspace(0, 0.9, 91), np.linspace(0.9, 1, 201)]))
+# bytes of similarities and temporaries held at once by similarity_cutoff(): if
+# the (n_input, n_database) float32 similarity matrix does not fit in half of it,
+# the database is streamed in chunks into histograms
+cutoff_memory_budget = 2**28
+# number of histogram bins on [-1, 1] of the streamed similarity distributions
+cutoff_hist_bins = 4096
+
+
+def similarity_cutoff(feat_input, features, threshold=0.95, timing=False, memory_budget=None):
     """
     Given list of input feature and feature database, compute distribution of
-    cosine similarityof the database with respect to each input. Find similarity
+    cosine similarity of the database with respect to each input. Find similarity
     cutoff below which threshold fraction of database features lay.
 
+    If the (n_input, n_database) similarity matrix fits in half of memory_budget,
+    leaving the other half to the chunks it is filled from, cutoffs of all
+    inputs are exact quantiles computed at once along its rows. Otherwise
+    the database is streamed in chunks into per-input histograms, see
+    similarity_histogram(), once per group of inputs whose histograms fit in
+    half of memory_budget, and quantiles are interpolated from them. Either way
+    the distributions are kept as their values at the cdf_quantiles levels, which
+    is enough to interpolate the CDF of any similarity.
+
     Args:
       feat_input: (n_input, N) array of features for input
-      features: (n_database, N) array of features for logo database
+      features: (n_database, N) array or Int8Features of features for logo
+        database, possibly memory-mapped
       threshold: fractional threshold for setting the cutoff
+      memory_budget: bytes of similarities, histograms and their temporaries
+        held at once, not counting the returned knots, default
+        cutoff_memory_budget
     Returns:
       cutoff_list: list of cutoffs for each input
-      (bins, cdf_list): bins specifications and list of CDF distributions
-        for similarity of the logo database against each input.
+      (bins, cdf_list): quantile levels and (n_input, len(bins)) array of the
+        similarity of the logo database against each input at these levels.
     """
 
     start = timer()
-    cs = cosine_similarity(X = feat_input, Y = features)
-
-    cutoff_list = []
-    cdf_list = []
-    for i, cs1 in enumerate(cs):
-        hist, bins = np.histogram(cs1, bins=np.arange(0,1,0.001))
-        cdf = np.cumsum(hist)/len(cs1)
-        cutoff = bins[np.where(cdf < threshold)][-1]
-        cutoff_list.append(cutoff)
-        cdf_list.append(cdf)
+    memory_budget = cutoff_memory_budget if memory_budget is None else memory_budget
+    levels = np.append(cdf_quantiles, threshold)
+    if 8 * len(feat_input) * len(features) <= memory_budget:
+        cs = np.empty((len(feat_input), len(features)), dtype=np.float32)
+        chunk_size = database_chunk_rows(feat_input, features, memory_budget - cs.nbytes)
+        for i in range(0, len(features), chunk_size):
+            cs[:, i:i+chunk_size] = database_similarity(feat_input, features[i:i+chunk_size])
+        # partition cs in place rather than a sorted copy of it
+        knots = np.quantile(cs, levels, axis=1, overwrite_input=True).T
+    else:
+        knots = np.empty((len(feat_input), len(levels)))
+        group = histogram_group_size(cutoff_hist_bins, memory_budget)
+        for i in range(0, len(feat_input), group):
+            hist = similarity_histogram(feat_input[i:i+group], features, memory_budget=memory_budget)
+            knots[i:i+group] = histogram_quantiles(hist, levels)
+            # freed before the histograms of the next group are allocated
+            del hist
+    cutoff_list = list(knots[:, -1])
+    cdf_list = knots[:, :-1]
     end = timer()
     print('Computed similarity cutoffs given inputs in {:.2f}sec'.format(end - start))
 
-    return cutoff_list, (bins, cdf_list)
+    return cutoff_list, (cdf_quantiles, cdf_list)
+
+
+def database_similarity(feat_input, features):
+    """
+    (n_input, n_rows) float32 cosine similarity of inputs against rows of the
+    feature database. The few inputs are normalized, and the products divided by
+    the database row norms rather than building a normalized copy of the rows.
+    """
+    if isinstance(features, Int8Features):
+        db_norms = features.norms()
+        cs = (features @ l2_normalize(feat_input).T).T
+    else:
+        features = np.asarray(features).astype(np.float32, copy=False)
+        db_norms = np.sqrt(np.einsum('ij,ij->i', features, features))
+        cs = l2_normalize(feat_input) @ features.T
+    cs /= np.maximum(db_norms, 1e-12)
+    return cs
+
+
+def database_chunk_rows(feat_input, features, memory_budget):
+    """
+    Number of database rows per chunk such that the float32 copy of the rows
+    and their similarities with temporaries, counted as 24 bytes each (float32
+    similarity, histogram bin, intp copy in bincount and slack), fit in
+    memory_budget.
+    """
+    row_bytes = 4 * features.shape[1] + 24 * len(feat_input)
+    if memory_budget < row_bytes:
+        raise Exception(f'Memory budget of {memory_budget} bytes cannot hold the similarities of '
+                        f'one database row ({row_bytes} bytes)')
+    return memory_budget // row_bytes
 
 
-def load_brands_compute_cutoffs(input_paths, model_preproc, features, threshold = 0.95, timing=False):
+def histogram_group_size(n_bins, memory_budget):
+    """
+    Number of inputs whose int32 histograms fit in half of memory_budget, the
+    other half being left to the database chunks streamed into them.
+    """
+    group = (memory_budget // 2) // (4 * n_bins)
+    if group < 1:
+        raise Exception(f'Memory budget of {memory_budget} bytes cannot hold the histogram of '
+                        f'one input ({4 * n_bins} bytes) and a database chunk')
+    return group
+
+
+def similarity_histogram(feat_input, features, n_bins=None, memory_budget=None):
+    """
+    Histograms on [-1, 1] of the cosine similarity of the feature database
+    against each input, computed over chunks of database rows so that memory
+    stays bounded by memory_budget, histograms included, whatever the database
+    size. Histograms of parts of a database add up to the histogram of the
+    whole. The histograms of all inputs must fit in half of memory_budget, see
+    histogram_group_size() to split many inputs into groups.
+
+    Args:
+      feat_input: (n_input, N) array of features for input
+      features: (n_database, N) array or Int8Features of features for logo
+        database, possibly memory-mapped
+      n_bins: number of bins, default cutoff_hist_bins
+      memory_budget: bytes of the histograms, similarity chunk and their
+        temporaries, default cutoff_memory_budget
+    Returns:
+      hist: (n_input, n_bins) int32 array of counts
+    """
+    n_bins = n_bins or cutoff_hist_bins
+    memory_budget = memory_budget or cutoff_memory_budget
+    if len(feat_input) > histogram_group_size(n_bins, memory_budget):
+        raise Exception(f'Histograms of {len(feat_input)} inputs do not fit in half of the memory '
+                        f'budget of {memory_budget} bytes')
+    hist = np.zeros((len(feat_input), n_bins), dtype=np.int32)
+    chunk_size = database_chunk_rows(feat_input, features, memory_budget - hist.nbytes)
+
+    for i in range(0, len(features), chunk_size):
+        cs = database_similarity(feat_input, features[i:i+chunk_size])
+        cs += 1.
+        cs *= n_bins / 2.
+        idx = cs.astype(np.int32)
+        del cs
+        np.clip(idx, 0, n_bins - 1, out=idx)
+        # one input at a time, so that no temporary is as large as hist
+        for row, bins in zip(hist, idx):
+            row += np.bincount(bins, minlength=n_bins)
+    return hist
+
+
+def histogram_quantiles(hist, levels):
+    """
+    Quantiles of the distributions of similarity_histogram(), linearly
+    interpolated within bins.
+
+    Args:
+      hist: (n_input, n_bins) array of counts of bins on [-1, 1]
+      levels: quantile levels in [0, 1]
+    Returns:
+      (n_input, len(levels)) array of quantiles
+    """
+    n_bins = hist.shape[1]
+    # level 0 is the lower edge of the first non-empty bin, not -1
+    levels = np.maximum(np.asarray(levels, dtype=np.float64), 1e-12)
+
+    # one input at a time, so that no temporary is as large as hist
+    knots = np.empty((len(hist), len(levels)))
+    for i, row in enumerate(hist):
+        cdf = np.cumsum(row) / max(row.sum(), 1)
+        pos = np.clip(np.searchsorted(cdf, levels, side='left'), 0, n_bins - 1)
+        cdf_prev = np.where(pos > 0, cdf[np.maximum(pos - 1, 0)], 0.)
+        cdf_bin = cdf[pos]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(cdf_bin > cdf_prev, (levels - cdf_prev) / (cdf_bin - cdf_prev), 0.)
+        knots[i] = -1. + (pos + np.clip(t, 0., 1.)) * (2. / n_bins)
+    return knots
+
+
+def features_fingerprint(features, n_rows=1024):
+    """
+    Cheap fingerprint of a feature database: hash of its shape, dtype and an
+    evenly strided sample of about n_rows rows, so that a memory-mapped
+    database does not have to be read in full.
+    """
+    h = hashlib.sha1()
+    h.update(repr((features.shape, str(features.dtype))).encode())
+    step = max(1, len(features) // n_rows)
+    h.update(np.ascontiguousarray(features[::step]).tobytes())
+    return h.hexdigest()
+
+
+def cutoff_cache_path(cache_dir, image_hash, db_fingerprint, extractor_key, threshold):
+    """
+    Path of the cached (feat_input, cutoff, cdf) of one brand image, keyed by
+    image content hash, feature database fingerprint, extractor and threshold.
+    Any change in these gives a different file, so stale entries are never read.
+    """
+    key = '|'.join([image_hash, db_fingerprint, extractor_key, repr(float(threshold)),
+                    str(cutoff_cache_version)])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+def load_brands_compute_cutoffs(input_paths, model_preproc, features, threshold = 0.95, timing=False,
+                                cache_dir=None, extractor_key=''):
     """
     Given paths to input brand images, this is a wrapper to features_from_image()
     and similarity_cutoff().
 
+    Results for each brand image are cached on disk, so re-runs with the same
+    brands only read the images and skip feature extraction and cutoffs.
+
     Args:
       input_paths: list of paths to input images
       model_preproc: (model, preprocess) tuple of model extractor and
         image preprocessing function
       features: (n_database, N) array of features for logo database
       threshold: fractional threshold for setting the cutoff
+      cache_dir: directory of cached cutoffs, default cutoff_cache_dir, empty
+        string to disable caching
+      extractor_key: string identifying the feature extractor (e.g. features
+        file name), part of the cache key
     Returns:
       img_input: list of iamges (3D np.arrays)
       feat_input: (n_input, F) array of 1D features extracted from input images
       cutoff_list: list of cutoffs for each input
-      (bins, cdf_list): bins specifications and list of CDF distributions
-        for similarity of the logo database against each input.
+      (bins, cdf_list): quantile levels and list of the similarity of the
+        logo database against each input at these levels.
     """
 
     start = timer()
     img_input = []
+    img_hashes = []
     for path in input_paths:
-        img = cv2.imread(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
         # apppend images in RGB color ordering
         if img is not None:
             img_input.append(img[:,:,::-1])
+            img_hashes.append(hashlib.sha1(data).hexdigest())
         else:
             print(path)
 
     t_read  = timer()-start
     model, my_preprocess = model_preproc
-    img_input = np.array(img_input)
-    feat_input = features_from_image(img_input, model, my_preprocess)
+
+    cache_dir = cutoff_cache_dir if cache_dir is None else cache_dir
+    cache_paths = [''] * len(img_input)
+    cached = {}
+    if cache_dir:
+        db_fingerprint = features_fingerprint(features)
+        for i, img_hash in enumerate(img_hashes):
+            cache_paths[i] = cutoff_cache_path(cache_dir, img_hash, db_fingerprint, extractor_key, threshold)
+            entry = load_cutoff_cache(cache_paths[i])
+            if entry is not None:
+                cached[i] = entry
+    missing = [i for i in range(len(img_input)) if i not in cached]
+
+    feat_new = features_from_image([img_input[i] for i in missing], model, my_preprocess)
     t_feat = timer()-start
 
-    sim_cutoff, (bins, cdf_list)= similarity_cutoff(feat_input, features, threshold, timing)
+    if missing:
+        cutoff_new, (bins, cdf_new) = similarity_cutoff(feat_new, features, threshold, timing)
+        for k, i in enumerate(missing):
+            cached[i] = (feat_new[k], cutoff_new[k], cdf_new[k], bins)
+            if cache_paths[i]:
+                save_cutoff_cache(cache_paths[i], *cached[i])
     t_sim_cut = timer()-start
 
+    feat_input = np.array([cached[i][0] for i in range(len(img_input))])
+    sim_cutoff = [cached[i][1] for i in range(len(img_input))]
+    cdf_list = [cached[i][2] for i in range(len(img_input))]
+    bins = cached[0][3] if cached else cdf_quantiles
+
     if timing:
         print('Time spent in each section:')
         print('-reading images: {:.2f}sec\n-features: {:.2f}sec\n-cosine similarity: {:.2f}sec'.format(
           t_read, t_feat-t_read, t_sim_cut-t_feat
           ))
+        print('-{} of {} brands loaded from cache'.format(len(img_input)-len(missing), len(img_input)))
 
     print('Resulting 95% similarity threshold for targets:')
     for path, cutoff in zip(input_paths, sim_cutoff):
@@ -91,15 +301,95 @@ def load_brands_compute_cutoffs(input_paths, model_preproc, features, threshold
     return img_input, feat_input, sim_cutoff, (bins, cdf_list)
 
 
+def load_cutoff_cache(path):
+    """
+    Read one cache entry of load_brands_compute_cutoffs(): (feat, cutoff, cdf,
+    bins), or None if missing. An unreadable entry (e.g. truncated by a full
+    disk) is deleted and treated as missing, so that it is computed again.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as entry:
+            return entry['feat'], float(entry['cutoff']), entry['cdf'], entry['bins']
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile) as e:
+        print('Ignoring corrupt similarity cutoff cache {}: {}'.format(path, e))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+
+def save_cutoff_cache(path, feat, cutoff, cdf, bins):
+    """
+    Write one cache entry of load_brands_compute_cutoffs() under a temporary
+    name unique to the process and rename it, so that readers never see a
+    partial file and concurrent workers do not write to the same file.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, feat=feat, cutoff=cutoff, cdf=cdf, bins=bins)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('Could not cache similarity cutoff in {}: {}'.format(path, e))
+
+
+
+def l2_normalize(x, eps=1e-12):
+    """
+    Scale rows of a 2D array to unit L2 norm, as float32. All-zero rows stay zero.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), eps)
+
+
+def similarity_cdf(cos_sim, bins, cdf_list, rows=None):
+    """
+    Interpolate the CDF of the similarity distribution of each input at every
+    entry of a similarity matrix, with one searchsorted over all inputs.
+
+    Args:
+      cos_sim: (n_input, n_candidates) cosine similarity matrix
+      bins, cdf_list: quantile levels and (n_input, len(bins)) similarity of the
+        logo database against each input at these levels
+      rows: optional integer array of the shape of cos_sim, input index of each
+        similarity, default row i of cos_sim for input i
+    Returns:
+      cdf: array of CDF values in [0, 1], of the shape of cos_sim
+    """
+    knots = np.asarray(cdf_list, dtype=np.float64)
+    n_input, n_knots = knots.shape
+    if rows is None:
+        rows = np.arange(n_input)[:, None]
+
+    # similarities lie in [-1, 1]: shifting each row by a multiple of 3 keeps the
+    # concatenated knots sorted and the rows apart
+    offset = 3. * np.arange(n_input)[:, None]
+    pos = np.searchsorted((knots + offset).ravel(), cos_sim + 3. * rows, side='right')
+    pos = np.clip(pos - n_knots * rows, 1, n_knots - 1)
+
+    x0, x1 = knots[rows, pos-1], knots[rows, pos]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(x1 > x0, (cos_sim - x0) / (x1 - x0), 1.)
+    t = np.clip(t, 0., 1.)
+    return bins[pos-1] + t * (bins[pos] - bins[pos-1])
+
 
 def similar_matches(feat_input, features_cand, cutoff_list, bins, cdf_list):
     """
     Given features of inputs to check candidates against, compute cosine
     similarity and define a match if cosine similarity is above a cutoff.
+    One-off wrapper around BrandIndex.match().
 
     Args:
       feat_input:    (n_input, N) array of features for input
       features_cand: (n_candidates, N) array of features for candidates
+      cutoff_list: list of similarity cutoffs for each input
+      bins, cdf_list: quantile levels and similarity of the logo database
+        against each input at these levels, as returned by similarity_cutoff()
 
     Returns:
       matches: dictionary mapping each logo match to its input brand and its CDF value.
@@ -113,36 +403,97 @@ def similar_matches(feat_input, features_cand, cutoff_list, bins, cdf_list):
     assert feat_input.shape[1] == features_cand.shape[1], 'matrices should have same columns'
     assert len(cutoff_list) == len(feat_input), 'there should be one similarity cutoff for each input logo'
 
-    cos_sim = cosine_similarity(X = feat_input, Y = features_cand)
+    matches, cos_sim = BrandIndex(feat_input, cutoff_list, bins, cdf_list).match(features_cand)
+
+    return matches, cos_sim
+
 
-    # similarity cutoffs are defined 3 significant digits, approximate cos_sim for consistency
-    cos_sim = np.round(cos_sim, 3)
+class BrandIndex(object):
+    """
+    Input brands to match candidate logos against, prepared once for the whole
+    run: L2-normalized brand features, their similarity cutoffs and the quantile
+    knots of the similarity of the logo database against each of them. Cosine
+    similarity of candidates against all brands is then a single matrix product.
+
+    For large catalogs, an approximate search backend such as
+    brand_search.IVFSearch only compares candidates to their most similar
+    brands, which are then checked against their cutoffs as usual.
+
+    Args:
+      feat_input: (n_input, N) array of features for input
+      cutoff_list: list of similarity cutoffs for each input
+      bins, cdf_list: quantile levels and similarity of the logo database
+        against each input at these levels, as returned by similarity_cutoff()
+      dtype: storage type of the normalized brand features, float32, float16
+        or int8 for Int8Features
+      search: nearest-neighbour search backend from brand_search, default
+        ExactSearch() comparing candidates to every brand
+    """
 
-    # for each input, return matches if above threshold
-    # matches = []
-    matches = {}
-    for i in range(len(feat_input)):
-        # matches = [ c for c in range(len(features_cand)) if cc[i] > cutoff_list[i]]
-        # alternatively in numpy, get indices of
-        match_indices = np.where(cos_sim[i] >= cutoff_list[i])
+    def __init__(self, feat_input, cutoff_list, bins, cdf_list, dtype=np.float32, search=None):
+        brands = l2_normalize(feat_input)
+        self.brands = quantize_int8(brands) if np.dtype(dtype) == np.int8 else brands.astype(dtype)
+        self.cutoffs = np.asarray(cutoff_list, dtype=np.float64)
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.knots = np.asarray(cdf_list, dtype=np.float64).reshape(len(self.brands), -1)
+        self.search = (search if search is not None else ExactSearch()).fit(self.brands)
+
+    @classmethod
+    def from_sim_threshold(cls, sim_threshold, dtype=np.float32, search=None):
+        """
+        Build index from a (feat_input, sim_cutoff, (bins, cdf_list)) tuple as
+        returned by load_brands_compute_cutoffs().
+        """
+        feat_input, sim_cutoff, (bins, cdf_list) = sim_threshold
+        return cls(feat_input, sim_cutoff, bins, cdf_list, dtype, search)
+
+    def __len__(self):
+        return len(self.brands)
+
+    def _dense(self, sims, ids):
+        '''scatter (n_candidates, k) search results into a (n_input, n_candidates) matrix'''
+        cos_sim = np.full((len(self.brands), len(sims)), np.nan, dtype=np.float32)
+        valid = ids >= 0
+        cos_sim[ids[valid], np.nonzero(valid)[0]] = sims[valid]
+        return cos_sim
+
+    def match(self, features_cand):
+        """
+        Define a match if cosine similarity is above the cutoff of a brand. If a
+        candidate matches several brands, pick the one at the highest percentile.
+
+        Args:
+          features_cand: (n_candidates, N) array of features for candidates
+        Returns:
+          matches: dictionary mapping each logo match to its input brand and its CDF value.
+          cos_sim: (n_input, n_candidates) cosine similarity matrix between inputs and candidates.
+        """
+        if len(features_cand)==0:
+            print('Found 0 logos from 0 classes')
+            return {}, np.array([])
+
+        assert self.brands.shape[1] == features_cand.shape[1], 'matrices should have same columns'
+
+        # (n_candidates, k) similarities to the brands returned by the search backend
+        sims, ids = self.search.search(l2_normalize(features_cand))
+        cos_sim = self._dense(sims, ids)
+        valid = ids >= 0
+        ids = np.where(valid, ids, 0)
+
+        # percentile of each similarity in the distribution of the database against each input
+        cdf = similarity_cdf(sims, self.bins, self.knots, rows=ids)
 
         # to avoid double positives if candidate is above threshold for multiple inputs,
         # will pick input with better cosine_similarity, meaning the one at the highest percentile
-        for idx in match_indices[0]:
-            cdf_match = cdf_list[i][bins[:-1] < cos_sim[i, idx]][-1]
-            # if candidate not seen previously, current brand is best guess so far
-            if idx not in matches:
-                matches[idx] = (i, cdf_match)
-            # if previously seen at lower confidence, replace with current candidate
-            elif matches[idx][1] < cdf_match:
-                matches[idx] = (i, cdf_match)
-            else:
-                continue
-
-    n_classes = len(np.unique([v[0] for v in matches.values()]))
-    print('Found {} logos from {} classes'.format(len(matches), n_classes))
+        above = valid & (sims >= self.cutoffs[ids])
+        best = np.argmax(np.where(above, cdf, -np.inf), axis=1)
+        matched = np.flatnonzero(above.any(axis=1))
+        matches = {idx: (ids[idx, best[idx]], cdf[idx, best[idx]]) for idx in matched}
 
-    return matches, cos_sim
+        n_classes = len(np.unique([v[0] for v in matches.values()]))
+        print('Found {} logos from {} classes'.format(len(matches), n_classes))
+
+        return matches, cos_sim
 
 
 def draw_matches(img_test, inputs, prediction, matches):
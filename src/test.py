@@ -11,7 +11,7 @@ from timeit import default_timer as timer
 
 from logos import detect_logo, match_logo
 from similarity import load_brands_compute_cutoffs
-from utils import load_extractor_model, load_features, model_flavor_from_name, parse_input
+from utils import load_extractor_model, load_features, model_flavor_from_name, parse_input, pooling_from_name
 import utils
 
 sim_threshold = 0.95
@@ -41,8 +41,9 @@ def test(filename):
     features, brand_map, input_shape = load_features(filename)
 
     ## load inception model
-    model, preprocess_input, input_shape = load_extractor_model(model_name, flavor)
-    my_preprocess = lambda x: preprocess_input(utils.pad_image(x, input_shape))
+    model, preprocess_input, input_shape = load_extractor_model(model_name, flavor,
+                                                                pooling=pooling_from_name(filename))
+    my_preprocess = utils.CropPreprocess(preprocess_input, input_shape)
 
     ## load sample images of logos to test against
     input_paths = ['test_batman.jpg', 'test_robin.png', 'test_lexus.png', 'test_champions.jpg',
@@ -52,7 +53,8 @@ def test(filename):
 
     # compute cosine similarity between input brand images and all LogosInTheWild logos
     ( img_input, feat_input, sim_cutoff, (bins, cdf_list)
-    ) = load_brands_compute_cutoffs(input_paths, (model, my_preprocess), features, sim_threshold, timing=True)
+    ) = load_brands_compute_cutoffs(input_paths, (model, my_preprocess), features, sim_threshold, timing=True,
+                                  extractor_key=os.path.basename(filename))
 
     images = [ p for p in os.listdir(os.path.join(test_dir, 'sample_in/')) if p.endswith('.jpg')]
     images_path = [ os.path.join(test_dir, 'sample_in/',p) for p in images]
@@ -0,0 +1,55 @@
+"""Accuracy loss of int8 features against float32 features."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from brand_search import synthetic_catalog
+from quantization import Int8Features, quantize_int8
+
+N_DATABASE = 5000
+N_INPUT = 20
+
+
+def unit_features(dim, seed=1):
+    '''non-negative L2-normalized (database, input) features, as after a ReLU'''
+    x = np.abs(synthetic_catalog(N_DATABASE + N_INPUT, dim, seed=seed))
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x[:N_DATABASE], x[N_DATABASE:]
+
+
+@pytest.mark.parametrize('dim', [512, 2048])
+def test_int8_cosine_similarity(dim):
+    db, queries = unit_features(dim)
+    db_int8 = quantize_int8(db)
+
+    assert isinstance(db_int8, Int8Features)
+    np.testing.assert_allclose(db_int8.norms(), 1, atol=0.01)
+    assert np.abs(db_int8 @ queries.T - db @ queries.T).max() <= 0.0025
+
+
+@pytest.mark.parametrize('memory_budget', [None, 2**16], ids=['exact', 'streaming'])
+@pytest.mark.parametrize('dim', [512, 2048])
+def test_int8_similarity_cutoff(dim, memory_budget):
+    similarity = pytest.importorskip('similarity')
+    db, queries = unit_features(dim)
+
+    cutoffs, (_, knots) = similarity.similarity_cutoff(queries, db, 0.95, memory_budget=memory_budget)
+    cutoffs_int8, (_, knots_int8) = similarity.similarity_cutoff(queries, quantize_int8(db), 0.95,
+                                                                 memory_budget=memory_budget)
+
+    np.testing.assert_allclose(cutoffs_int8, cutoffs, atol=3e-4)
+    np.testing.assert_allclose(knots_int8, knots, atol=3e-3)
+
+
+def test_int8_features_indexing():
+    x = np.random.RandomState(0).normal(size=(5, 8)).astype(np.float32)
+    x_int8 = quantize_int8(x)
+
+    for idx in [0, 2, -1, -5]:
+        np.testing.assert_array_equal(np.asarray(x_int8[idx]), np.asarray(x_int8)[[idx]])
+    np.testing.assert_array_equal(np.asarray(x_int8[1:-1]), np.asarray(x_int8)[1:-1])
@@ -1,17 +1,31 @@
-import colorsys
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import h5py
 from keras import Model
+from keras import backend as K
+from keras.layers import GlobalAveragePooling2D, GlobalMaxPooling2D, Lambda
+from keras.models import load_model
 import numpy as np
 import os
 from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
 from timeit import default_timer as timer
 
+from keras_yolo3.yolo3.utils import annotation_font, class_colors
+from quantization import Int8Features, quantize_int8
+
 import readline
 readline.parse_and_bind("tab: complete")
 
 min_logo_size = (10,10)
+# threads preprocessing crops for the feature extractor (cv2/numpy release the GIL)
+preprocess_workers = min(8, os.cpu_count() or 1)
+# optional pooling of the extractor output, see pool_extractor()
+pooling_modes = ('avg', 'max', 'spp')
+# images per forward pass of the feature extractor in features_from_image()
+feature_batch_size = 100
+# truncated feature extractors are saved here after the first build
+extractor_cache_dir = os.path.expanduser(os.path.join('~', '.keras', 'logohunter'))
 
 def parse_input():
     """
@@ -33,60 +47,187 @@ def parse_input():
     return out
 
 
-def load_extractor_model(model_name='InceptionV3', flavor=1):
+def load_extractor_model(model_name='InceptionV3', flavor=1, pooling=None, cache_dir=None, warmup=True):
     """Load variant of InceptionV3 or VGG16 model specified.
 
+    The truncated model is saved once as an H5 file in cache_dir and loaded
+    directly from there on later starts, skipping the ImageNet model build and
+    truncation. Warm-up inferences then run at two small batch sizes, so that
+    the predict function is traced for a variable batch dimension and neither
+    full nor partial batches of features_from_image() pay the graph-tracing
+    cost.
+
     Args:
       model_name: string, either InceptionV3 or VGG16
       flavor: int specifying the model variant and input_shape.
         For InceptionV3, the map is {0: default, 1: 200*200, truncate last Inception block,
         2: 200*200, truncate last 2 blocks, 3: 200*200, truncate last 3 blocks, 4: 200*200}
         For VGG16, it only changes the input size, {0: 224 (default), 1: 128, 2: 64}.
+      pooling: None to flatten the whole feature map, or one of pooling_modes,
+        see pool_extractor()
+      cache_dir: directory of cached extractors, default extractor_cache_dir,
+        empty string to disable caching
+      warmup: run inferences on blank images before returning
 """
     start = timer()
     if model_name == 'InceptionV3':
-        from keras.applications.inception_v3 import InceptionV3
         from keras.applications.inception_v3 import preprocess_input
-        model = InceptionV3(weights='imagenet', include_top=False)
-
-        trunc_layer = [-1, 279, 248, 228, -1]
-        i_layer = flavor
-        model_out = Model(inputs=model.inputs, outputs=model.layers[trunc_layer[i_layer]].output)
         input_shape = (299,299,3) if flavor==0 else (200,200,3)
-
     elif model_name == 'VGG16':
-        from keras.applications.vgg16 import VGG16
         from keras.applications.vgg16 import preprocess_input
-        model_out = VGG16(weights='imagenet', include_top=False)
         input_length = [224,128,64][flavor]
         input_shape = (input_length,input_length,3)
 
+    cache_dir = extractor_cache_dir if cache_dir is None else cache_dir
+    cache_path = os.path.join(cache_dir, '{}_{}.h5'.format(model_name, flavor)) if cache_dir else ''
+
+    if cache_path and os.path.exists(cache_path):
+        model_out = load_model(cache_path, compile=False)
+    else:
+        if model_name == 'InceptionV3':
+            from keras.applications.inception_v3 import InceptionV3
+            model = InceptionV3(weights='imagenet', include_top=False)
+
+            trunc_layer = [-1, 279, 248, 228, -1]
+            i_layer = flavor
+            model_out = Model(inputs=model.inputs, outputs=model.layers[trunc_layer[i_layer]].output)
+
+        elif model_name == 'VGG16':
+            from keras.applications.vgg16 import VGG16
+            model_out = VGG16(weights='imagenet', include_top=False)
+
+        if cache_path:
+            # write to a temporary file first so concurrent workers never load a partial file
+            tmp_path = '{}.{}.tmp.h5'.format(os.path.splitext(cache_path)[0], os.getpid())
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                model_out.save(tmp_path)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                print('Could not cache feature extractor in {}: {}'.format(cache_path, e))
+
+    model_out = pool_extractor(model_out, pooling)
+
+    if warmup:
+        # two distinct sizes are enough to relax the traced batch dimension
+        for batch_size in (1, 2):
+            model_out.predict_on_batch(np.zeros((batch_size,) + input_shape, dtype='float32'))
+
     end = timer()
     print('Loaded {} feature extractor in {:.2f}sec'.format(model_name, end-start))
     return model_out, preprocess_input, input_shape
 
 
+def spatial_pyramid_pooling(x, levels=(1, 2)):
+    """
+    Max-pool a (batch, H, W, C) feature map over an n*n grid of cells for each
+    pyramid level n, and concatenate the results to (batch, sum(n*n)*C).
+    """
+    h, w = K.shape(x)[1], K.shape(x)[2]
+    pooled = []
+    for n in levels:
+        for i in range(n):
+            for j in range(n):
+                # cell boundaries rounded outwards so that no row/column is dropped
+                y0, y1 = (i * h) // n, ((i + 1) * h + n - 1) // n
+                x0, x1 = (j * w) // n, ((j + 1) * w + n - 1) // n
+                pooled.append(K.max(x[:, y0:y1, x0:x1, :], axis=[1, 2]))
+    return K.concatenate(pooled, axis=-1)
+
+
+def pool_extractor(model, pooling=None):
+    """
+    Append pooling to the output of a truncated feature extractor, to shrink
+    feature vectors from H*W*C to C ('avg', 'max') or 5*C ('spp', 1x1 and
+    2x2 spatial pyramid).
+
+    Args:
+      model: keras model with a (batch, H, W, C) output
+      pooling: None (no pooling) or one of pooling_modes
+    Returns:
+      keras model with pooled output
+    """
+    if pooling is None:
+        return model
+    if pooling == 'avg':
+        out = GlobalAveragePooling2D()(model.output)
+    elif pooling == 'max':
+        out = GlobalMaxPooling2D()(model.output)
+    elif pooling == 'spp':
+        out = Lambda(spatial_pyramid_pooling)(model.output)
+    else:
+        raise Exception(f'Pooling not recognized: {pooling}')
+    return Model(inputs=model.inputs, outputs=out)
+
+
+def pool_features(features, feature_map_shape, pooling=None):
+    """
+    NumPy version of pool_extractor() for features already extracted without
+    pooling, so that pooled variants do not need another extractor pass.
+
+    Args:
+      features: (N, H*W*C) array of flattened extractor outputs
+      feature_map_shape: (H, W, C) of the extractor output
+      pooling: None (no pooling) or one of pooling_modes
+    Returns:
+      (N, F) array of pooled features
+    """
+    if pooling is None:
+        return features
+    h, w, c = feature_map_shape
+    x = np.asarray(features).reshape(-1, h, w, c)
+    if pooling == 'avg':
+        return x.mean(axis=(1, 2))
+    elif pooling == 'max':
+        return x.max(axis=(1, 2))
+    elif pooling == 'spp':
+        pooled = []
+        for n in (1, 2):
+            for i in range(n):
+                for j in range(n):
+                    # same cells as spatial_pyramid_pooling()
+                    y0, y1 = (i * h) // n, ((i + 1) * h + n - 1) // n
+                    x0, x1 = (j * w) // n, ((j + 1) * w + n - 1) // n
+                    pooled.append(x[:, y0:y1, x0:x1, :].max(axis=(1, 2)))
+        return np.concatenate(pooled, axis=-1)
+    raise Exception(f'Pooling not recognized: {pooling}')
+
+
+def pooling_from_name(path):
+    """ Return extractor pooling (None or one of pooling_modes) from HDF5 filename,
+    e.g. inception_logo_features_200_trunc2_avg.hdf5 -> 'avg'
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for pooling in pooling_modes:
+        if stem.endswith('_' + pooling):
+            return pooling
+    return None
+
+
 def model_flavor_from_name(path):
     """ Return model name (InceptionV3 or VGG16) and model variant from HDF5 filename.
     """
     filename = os.path.basename(path)
-    if filename.startswith('inception'):
+    # pooled variants share model and flavor with the unpooled file name
+    pooling = pooling_from_name(path)
+    name = filename if pooling is None else filename.replace('_' + pooling + '.', '.')
+    if name.startswith('inception'):
         model_name = 'InceptionV3'
-        if filename == 'inception_logo_features.hdf5':
+        if name == 'inception_logo_features.hdf5':
             flavor = 0
-        elif filename == 'inception_logo_features_200_trunc1.hdf5':
+        elif name == 'inception_logo_features_200_trunc1.hdf5':
             flavor = 1
-        elif filename == 'inception_logo_features_200_trunc2.hdf5':
+        elif name == 'inception_logo_features_200_trunc2.hdf5':
             flavor = 2
-        elif filename == 'inception_logo_features_200_trunc3.hdf5':
+        elif name == 'inception_logo_features_200_trunc3.hdf5':
             flavor = 3
-        elif filename == 'inception_logo_features_200.hdf5':
+        elif name == 'inception_logo_features_200.hdf5':
             flavor = 4
         else:
             raise Exception(f'Model not recognized: {path}')
-    elif filename.startswith('vgg16'):
+    elif name.startswith('vgg16'):
         model_name = 'VGG16'
-        length = int(filename.split('_')[3].split('.')[0]) #vgg16_logo_features_NNN.hdf5
+        length = int(name.split('_')[3].split('.')[0]) #vgg16_logo_features_NNN.hdf5
         flavor = [224,128,64].index(length)
     else:
         raise Exception(f'Model not recognized as InceptionV3 or VGG16 from filename: {path}')
@@ -120,23 +261,126 @@ def chunks(l, n, preprocessing_function = None):
             yield np.array([func(el) for el in l[i:i + n]])
 
 
-def load_features(filename):
+def features_npy_paths(filename):
+    """
+    Paths of the uncompressed, memory-mappable copy of an HDF5 features file:
+    (features .npy, brand_map/input_shape .npz)
+    """
+    stem = os.path.splitext(filename)[0]
+    return stem + '_features.npy', stem + '_meta.npz'
+
+
+def features_int8_paths(filename):
+    """
+    Paths of the int8-quantized, memory-mappable copy of an HDF5 features file:
+    (int8 codes .npy, float32 scales .npy). brand_map and input_shape are in
+    the .npz of features_npy_paths().
+    """
+    stem = os.path.splitext(filename)[0]
+    return stem + '_features_int8.npy', stem + '_scales_int8.npy'
+
+
+def export_features_npy(filename, chunk_size=10000, quantized=False):
+    """
+    Write the features of an HDF5 file as a contiguous uncompressed .npy file
+    (plus brand_map and input_shape in a small .npz), copying chunk by chunk
+    so the whole database is never held in memory. Files are written under a
+    temporary name unique to the process and renamed, so readers never see a
+    partial file and concurrent exports do not write to the same file.
+
+    With quantized, features are L2-normalized and stored as int8 codes with
+    one scale per feature vector, see quantization.quantize_int8().
+    """
+    npy_path, meta_path = features_npy_paths(filename)
+    if quantized:
+        npy_path, scales_path = features_int8_paths(filename)
+    tmp_npy, tmp_meta = ['{}.{}.tmp'.format(p, os.getpid()) for p in (npy_path, meta_path)]
+    tmp_scales = '{}.{}.tmp'.format(scales_path, os.getpid()) if quantized else None
+
+    try:
+        with h5py.File(filename, 'r') as hf:
+            dset = hf['features']
+            out = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.int8 if quantized else dset.dtype,
+                                            shape=dset.shape)
+            scales = np.zeros(dset.shape[0], dtype=np.float32)
+            for i in range(0, dset.shape[0], chunk_size):
+                if quantized:
+                    chunk = quantize_int8(dset[i:i + chunk_size])
+                    out[i:i + chunk_size], scales[i:i + chunk_size] = chunk.codes, chunk.scales
+                else:
+                    out[i:i + chunk_size] = dset[i:i + chunk_size]
+            out.flush()
+            del out
+            with open(tmp_meta, 'wb') as f:
+                np.savez(f, brand_map=hf['brand_map'][()], input_shape=hf['input_shape'][()])
+
+        if quantized:
+            with open(tmp_scales, 'wb') as f:
+                np.save(f, scales)
+            os.replace(tmp_scales, scales_path)
+        os.replace(tmp_npy, npy_path)
+        os.replace(tmp_meta, meta_path)
+    except OSError:
+        # e.g. full disk: do not leave partial copies behind
+        for path in (tmp_npy, tmp_meta, tmp_scales):
+            if path and os.path.exists(path):
+                os.remove(path)
+        raise
+
+
+def load_features(filename, mmap=True, quantized=False):
     """
     Load pre-saved HDF5 features for all logos in the LogosInTheWild database
+
+    With mmap, the features are memory-mapped read-only from an uncompressed
+    .npy copy next to the HDF5 file, (re)generated on first use or when the
+    HDF5 file is newer. Startup is then near-instant and worker processes on
+    the same host share the page cache instead of each holding a copy.
+
+    With quantized, features are returned as quantization.Int8Features of
+    L2-normalized vectors, memory-mapped from an int8 copy of the HDF5 file.
+
+    If the copy cannot be written or read (e.g. read-only data directory),
+    features are loaded in memory from the HDF5 file instead.
     """
 
     start = timer()
-    # get database features
-    with  h5py.File(filename, 'r') as hf:
-        brand_map = list(hf.get('brand_map'))
-        input_shape = list(hf.get('input_shape'))
-        features = hf.get('features')
-        features = np.array(features)
+    features = None
+    if mmap or quantized:
+        try:
+            features, brand_map, input_shape = _load_features_npy(filename, mmap, quantized)
+        except OSError as e:
+            print('Could not load {} from a .npy copy, loading it in memory: {}'.format(filename, e))
+    if features is None:
+        # get database features
+        with  h5py.File(filename, 'r') as hf:
+            brand_map = hf['brand_map'][()].tolist()
+            input_shape = hf['input_shape'][()].tolist()
+            features = hf['features'][()]
+        if quantized:
+            features = quantize_int8(features)
     end = timer()
     print('Loaded {} features from {} in {:.2f}sec'.format(features.shape, filename, end-start))
 
     return features, brand_map, input_shape
 
+def _load_features_npy(filename, mmap, quantized):
+    '''features, brand_map and input_shape from the .npy copy of an HDF5 file,
+    (re)generated if missing or stale'''
+    npy_path, meta_path = features_npy_paths(filename)
+    if quantized:
+        npy_path, scales_path = features_int8_paths(filename)
+    required = (npy_path, meta_path, scales_path) if quantized else (npy_path, meta_path)
+    stale = not all(os.path.exists(p) for p in required) or (
+        os.path.exists(filename) and os.path.getmtime(filename) > os.path.getmtime(npy_path))
+    if stale:
+        export_features_npy(filename, quantized=quantized)
+    features = np.load(npy_path, mmap_mode='r' if mmap else None)
+    if quantized:
+        features = Int8Features(features, np.load(scales_path))
+    with np.load(meta_path) as meta:
+        return features, meta['brand_map'].tolist(), meta['input_shape'].tolist()
+
 def save_features(filename, features, brand_map, input_shape):
     """
     Save features to compressed HDF5 file for later use
@@ -156,30 +400,75 @@ def save_features(filename, features, brand_map, input_shape):
 
     return None
 
-def features_from_image(img_array, model, preprocess, batch_size = 100):
+def features_from_image(img_array, model, preprocess, batch_size = None, workers = None):
     """
     Extract features from image array given a decapitated keras model.
-    Use a generator to avoid running out of memory for large inputs.
+
+    Runs exactly ceil(N/batch_size) forward passes, the last one on a smaller
+    batch, and writes features into a preallocated output. Preprocessing runs
+    on a pool of worker threads into two alternating batch buffers, so the
+    next batch is prepared while the model runs on the current one.
+
+    If preprocess is a CropPreprocess, crops are resized and padded straight
+    into the batch buffer with pad_into() and the model preprocess_input is
+    applied to the whole batch at once.
 
     Args:
       img_array: (N, H, W, C) list/array of input images
       model: keras model, outputs
+      preprocess: function that processes image (3D array) to model input
+      batch_size: number of images per forward pass, default feature_batch_size
+      workers: number of preprocessing threads, default preprocess_workers
     Returns:
       features: (N, F) array of 1D features
     """
 
-    if len(img_array) == 0:
+    n_images = len(img_array)
+    if n_images == 0:
         return np.array([])
+    workers = preprocess_workers if workers is None else workers
+    batch_size = feature_batch_size if batch_size is None else batch_size
 
-    steps = len(img_array)//batch_size + 1
-    img_gen = chunks(img_array, batch_size, preprocessing_function = preprocess)
-    features = model.predict_generator(img_gen, steps = steps)
-
-    # if the generator has looped past end of array, cut it down
-    features = features[:len(img_array)]
+    if isinstance(preprocess, CropPreprocess):
+        shape, dtype = preprocess.input_shape, np.float32
+        put = pad_into
+        finish = preprocess.preprocess_input
+    else:
+        # preprocess one image up front to size the batch buffers
+        first = preprocess(img_array[0])
+        shape, dtype = first.shape, first.dtype
+        def put(buffer, i, img):
+            buffer[i] = preprocess(img)
+        finish = lambda batch: batch
+
+    buffers = [np.empty((min(batch_size, n_images),) + tuple(shape), dtype=dtype)
+               for _ in range(2)]
+    features = None
+
+    def fill(buffer, start):
+        n_batch = min(batch_size, n_images - start)
+        futures = [pool.submit(put, buffer, i, img_array[start + i]) for i in range(n_batch)]
+        return n_batch, futures
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = fill(buffers[0], 0)
+        for k, start in enumerate(range(0, n_images, batch_size)):
+            n_batch, futures = pending
+            for future in futures:
+                future.result()
+            batch = finish(buffers[k % 2][:n_batch])
+
+            # queue up the next batch while the model runs on this one
+            if start + batch_size < n_images:
+                pending = fill(buffers[(k + 1) % 2], start + batch_size)
+
+            # flatten last three dimensions to one
+            out = np.asarray(model.predict_on_batch(batch))
+            out = out.reshape(n_batch, -1)
+            if features is None:
+                features = np.empty((n_images, out.shape[1]), dtype=out.dtype)
+            features[start:start + n_batch] = out
 
-    # reshape features: flatten last three dimensions to one
-    features = features.reshape(features.shape[0], np.prod(features.shape[1:]))
     return features
 
 
@@ -225,6 +514,56 @@ def pad_image(img, shape, mode = 'constant_mean'):
     return new_im
 
 
+def pad_into(batch_buffer, index, img):
+    """
+    Resize and pad image into batch_buffer[index], with the same layout as
+    pad_image(img, shape, mode='constant_mean'). The resized image is copied
+    into its sub-window of the buffer and only the border around it is filled
+    with the image mean, so no padded copy of the image is allocated.
+
+    Args:
+      batch_buffer: (B, H', W', C) preallocated array
+      index: position in batch_buffer to write to
+      img: (H, W, C) input numpy array
+    """
+    out = batch_buffer[index]
+    ih, iw = img.shape[:2]
+    h, w = out.shape[:2]
+
+    # rescale image so that largest dimension matches target, then center it
+    scale = min(w/iw, h/ih)
+    nw, nh = int(iw * scale), int(ih * scale)
+    x0, y0 = (w - nw)//2, (h - nh)//2
+
+    out[y0:y0 + nh, x0:x0 + nw] = cv2.resize(img, (nw, nh))
+
+    # same value as np.pad(constant_values=np.mean(img)) casts to img.dtype
+    fill = np.array(np.mean(img)).astype(img.dtype)
+    out[:y0] = fill
+    out[y0 + nh:] = fill
+    out[y0:y0 + nh, :x0] = fill
+    out[y0:y0 + nh, x0 + nw:] = fill
+
+
+class CropPreprocess(object):
+    """
+    Preprocessing of logo crops for a feature extractor: pad_image() to the
+    model input_shape followed by the model preprocess_input().
+
+    Calling it on one image is equivalent to
+      lambda x: preprocess_input(pad_image(x, input_shape))
+    while features_from_image() uses pad_into() and applies preprocess_input
+    to whole batches.
+    """
+
+    def __init__(self, preprocess_input, input_shape):
+        self.preprocess_input = preprocess_input
+        self.input_shape = tuple(input_shape)
+
+    def __call__(self, img):
+        return self.preprocess_input(pad_image(img, self.input_shape))
+
+
 def bbox_colors(n):
     """
     Define n distinct bounding box colors
@@ -234,14 +573,7 @@ def bbox_colors(n):
     Returns:
       colors: (n, 3) np.array with RGB integer values in [0-255] range
     """
-    hsv_tuples = [(x / n, 1., 1.) for x in range(n)]
-    colors = 255 * np.array([ colorsys.hsv_to_rgb(*x) for x in hsv_tuples])
-
-    np.random.seed(10101)  # Fixed seed for consistent colors across runs.
-    np.random.shuffle(colors)  # Shuffle colors to decorrelate adjacent classes.
-    np.random.seed(None)  # Reset seed to default.
-
-    return colors.astype(int)
+    return np.array(class_colors(n), dtype=int).reshape(-1, 3)
 
 def contents_of_bbox(img, bbox_list):
     """
@@ -297,8 +629,7 @@ def draw_annotated_box(image, box_list_list, label_list, color_list):
       image: annotated PIL image object
     """
 
-    font_path = os.path.join(os.path.dirname(__file__), 'keras_yolo3/font/FiraMono-Medium.otf')
-    font = ImageFont.truetype(font = font_path, size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
+    font = annotation_font(image)
     thickness = (image.size[0] + image.size[1]) // 300
 
     draw = ImageDraw.Draw(image)